@@ -28,6 +28,10 @@ class Database(object):
         self._shutting_down = False
         self._outgoing_queues = {}
         self._processors = {}
+        # read-only processors and their queues, per table
+        self._readers = {}
+        self._reader_queues = {}
+        self._next_reader = 0
         self._incoming_responses = multiprocessing.Queue()
         self._lock = threading.RLock()
         self._responses = {}
@@ -53,6 +57,7 @@ class Database(object):
                     x = self._outgoing_queues.get(name, None)
                     if x:
                         x.put((None, None, '_quit', (), {}))
+                    self._stop_readers(name)
                 sent = known
             if not wait:
                 break
@@ -63,12 +68,17 @@ class Database(object):
         Kill all processor subprocesses.
         '''
         self._shutting_down = True
-        while self._processors:
+        while self._processors or self._readers:
             with self._lock:
                 for n,p in self._processors.items():
                     p.terminate()
                     if not p.is_alive():
                         del self._processors[n]
+                for n,readers in self._readers.items():
+                    for p in readers:
+                        p.terminate()
+                    if not any(p.is_alive() for p in readers):
+                        self._stop_readers(n)
             time.sleep(.001)
 
     def _cleanup(self):
@@ -82,26 +92,70 @@ class Database(object):
                 del self._responses[tid]
         return len(clean)
 
-    def _get_or_setup_command_queue(self, table_name):
+    def _get_or_setup_command_queue(self, table_name, operation=None):
         '''
-        Start up a queue_processor process for each table.
+        Start up a queue_processor process for each table, along with any
+        read-only processors, and return the queue that should receive the
+        provided operation.
         '''
         if self._shutting_down:
             return
         with self._lock:
+            config = self._config.table_config(table_name)
             if table_name not in self._outgoing_queues:
-                self._outgoing_queues[table_name] = multiprocessing.Queue()
+                self._outgoing_queues[table_name] = multiprocessing.Queue(config.MAX_QUEUE_SIZE)
             if table_name not in self._processors or not self._processors[table_name].is_alive():
-                self._processors[table_name] = p = multiprocessing.Process(
-                    target=processor.queue_processor,
-                    args=(self._config.table_config(table_name),
-                          table_name,
-                          self._outgoing_queues[table_name],
-                          self._incoming_responses))
-                p.daemon = True
-                p.start()
+                self._processors[table_name] = self._start_processor(
+                    config, table_name, self._outgoing_queues[table_name])
+            if config.READ_WORKERS and config.JOURNAL_MODE == 'wal' and config.BACKEND == 'sqlite':
+                queues = self._reader_queues.setdefault(table_name, [])
+                readers = self._readers.setdefault(table_name, [])
+                while len(queues) < config.READ_WORKERS:
+                    queues.append(multiprocessing.Queue(config.MAX_QUEUE_SIZE))
+                for i, queue in enumerate(queues):
+                    if i >= len(readers):
+                        readers.append(None)
+                    if readers[i] is None or not readers[i].is_alive():
+                        readers[i] = self._start_processor(config, table_name, queue, True)
+                if operation in processor.READ_OPERATIONS and operation not in processor.WRITER_READ_OPERATIONS:
+                    self._next_reader += 1
+                    return queues[self._next_reader % len(queues)]
         return self._outgoing_queues[table_name]
 
+    def _start_processor(self, config, table_name, queue, readonly=False):
+        p = multiprocessing.Process(
+            target=processor.queue_processor,
+            args=(config, table_name, queue, self._incoming_responses, readonly))
+        p.daemon = True
+        p.start()
+        return p
+
+    def _stop_readers(self, table_name):
+        '''
+        Ask the read-only processors for a table to quit, they are restarted
+        as necessary by _get_or_setup_command_queue().
+        '''
+        with self._lock:
+            self._readers.pop(table_name, None)
+            for queue in self._reader_queues.pop(table_name, ()):
+                queue.put((None, None, '_quit', (), {}))
+
+    def _send(self, outgoing, table_name, request):
+        '''
+        Queue up a request for a table's processor, with a _deadline for
+        the request to be handled by if it has a timeout.
+        '''
+        kwargs = request[4]
+        timeout = kwargs.pop('_timeout', None)
+        if timeout is None:
+            timeout = self._config.table_config(table_name).REQUEST_TIMEOUT
+        if timeout:
+            kwargs['_deadline'] = time.time() + timeout
+        try:
+            outgoing.put(request, False)
+        except Queue.Full:
+            raise exceptions.Overloaded("Too many requests are waiting for table %r", table_name)
+
     def _get_or_setup_response(self):
         '''
         Create a queue for every thread.  Workloads with large thread churn
@@ -159,8 +213,10 @@ class Database(object):
                 if resp == 'indexes':
                     # handle index updates
                     self._known_indexes[table_name] = response['value']
-                elif resp == 'quit':
+                elif resp == 'quit' and not response.get('readonly'):
+                    # readers would otherwise keep a dropped table open
                     self._processors.pop(table_name)
+                    self._stop_readers(table_name)
         self._response_router = None
 
     def _execute(self, table_name, operation, args, kwargs):
@@ -173,7 +229,7 @@ class Database(object):
         itself.
         '''
         # set up all of the necessary processors/queues
-        outgoing = self._get_or_setup_command_queue(table_name)
+        outgoing = self._get_or_setup_command_queue(table_name, operation)
         incoming = self._get_or_setup_response()
         self._setup_response_router_if_necessary()
         # get a counter so that we know which command is being executed
@@ -181,7 +237,7 @@ class Database(object):
             self._local.counter = 0
         self._local.counter += 1
         # get the processing started
-        outgoing.put((whoami(), self._local.counter, operation, args, kwargs))
+        self._send(outgoing, table_name, (whoami(), self._local.counter, operation, args, kwargs))
         while 1:
             # wait for the response
             me, id, response = incoming.get()
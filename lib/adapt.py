@@ -1,10 +1,17 @@
 
+from collections import defaultdict
+import cPickle
+import cStringIO
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal as decimal
 import itertools
 
 import json
+import pickletools
+import re
 import sqlite3
+import struct
+import zlib
 
 def _check(v, d):
     if v.tzinfo:
@@ -95,17 +102,200 @@ def _json_converter(v):
         # CONVERTERS_SET.
         k, v = v.popitem()
         return CONVERTERS[k](v)
-    elif v:
-        return dict(itertools.izip(itertools.imap(str, v.iterkeys()), v.itervalues()))
+    # Keys are left as the unicode that json decodes them to, copying every
+    # dict to make them str was most of the cost of decoding.
     return v
 
 def json_adapter(dictionary):
     return buffer(json.dumps(dictionary, default=_json_adapter, separators=(',',':')))
 
+def _binary_adapter(v):
+    adapt = ADAPTERS.get(type(v))
+    if adapt:
+        # ('__datetime', (...)) and the like
+        return adapt(v).popitem()
+    raise TypeError("can't adapt %r"%(v,))
+
+def _binary_converter(tag):
+    return CONVERTERS[tag[0]](tag[1])
+
+def binary_adapter(dictionary):
+    # The values that cPickle doesn't write itself (and only those) are
+    # passed to the persistent id function, which tags them.
+    pickler = cPickle.Pickler(2)
+    pickler.fast = 1
+    pickler.inst_persistent_id = _binary_adapter
+    pickler.dump(dictionary)
+    return buffer(pickler.getvalue())
+
+def binary_converter(data):
+    # only for documents read back from the table, see document_converter()
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(str(data)))
+    # tagged values are the only objects that can be loaded
+    unpickler.find_global = None
+    unpickler.persistent_load = _binary_converter
+    return unpickler.load()
+
 def json_converter(data):
-    return json.loads(str(data), object_hook=_json_converter)
+    '''
+    Decodes JSON, including request arguments, which are never compressed or
+    in the binary format.
+    '''
+    data = str(data)
+    if '"__' not in data:
+        # none of the ADAPTERS were used, so there's nothing to convert
+        return json.loads(data)
+    return json.loads(data, object_hook=_json_converter)
+
+def document_converter(data):
+    '''
+    Decodes a stored document, encoded in any of the formats and codecs
+    below.
+    '''
+    data = decompress(data)
+    if data[:1] == BINARY:
+        return binary_converter(data)
+    return json_converter(data)
+
+'''
+Documents can be stored as JSON, or in a binary format: pickles (protocol 2,
+which start with a PROTO opcode) of only the types that cPickle handles
+without importing anything, with the other values tagged like the JSON
+format does.  Unlike with JSON, values are read back with the types they
+were written with: str stays str, tuples stay tuples, and every dict isn't
+passed through _json_converter.  Encoding and decoding a document of 3k of
+JSON, without and with a datetime and a Decimal...
+
+>>> test_adapter.TestAdapter('_test_performance').debug()
+json encode 83.7us 80.7us
+json decode 149.4us 179.3us
+binary encode 30.9us 38.5us
+binary decode 36.3us 46.8us
+'''
+FORMATS = {
+    'json': json_adapter,
+    'binary': binary_adapter,
+}
+BINARY = '\x80'
+
+# The first byte of an encoded document says how it was encoded.  Documents
+# stored as plain JSON start with '{', which is how all of them were stored
+# before they could be compressed or stored in the binary format.
+# Compressed documents are raw deflate streams of the document in either
+# format, those compressed with a dictionary are preceded by its id.
+DEFLATE = '\x01'
+DEFLATE_DICTIONARY = '\x02'
+
+# decompressors primed with each dictionary that has been loaded, by id
+DICTIONARIES = {}
+
+def _dictionary_id(dictionary):
+    return zlib.crc32(dictionary) & 0xffffffff
+
+def add_dictionary(dictionary):
+    '''
+    Makes the documents compressed with the dictionary readable, returns its
+    id.
+    '''
+    id = _dictionary_id(dictionary)
+    if id not in DICTIONARIES:
+        # Python 2's zlib can't be given a preset dictionary, so the
+        # decompressor is primed by decompressing the dictionary itself, and
+        # copied for every document, which then refers back to it.
+        compress = zlib.compressobj(0, zlib.DEFLATED, -15)
+        decompress = zlib.decompressobj(-15)
+        decompress.decompress(compress.compress(dictionary) + compress.flush(zlib.Z_SYNC_FLUSH))
+        DICTIONARIES[id] = decompress
+    return id
+
+def decompress(data):
+    '''
+    Returns an encoded document as it was before it was compressed.
+    '''
+    data = str(data)
+    codec = data[:1]
+    if codec == DEFLATE:
+        return zlib.decompress(data[1:], -15)
+    elif codec == DEFLATE_DICTIONARY:
+        id, = struct.unpack('>I', data[1:5])
+        if id not in DICTIONARIES:
+            raise ValueError("unknown compression dictionary %08x"%(id,))
+        decompress = DICTIONARIES[id].copy()
+        return decompress.decompress(data[5:]) + decompress.flush()
+    return data
+
+class Codec(object):
+    '''
+    Encodes the documents of a table in one of the FORMATS, uncompressed when
+    compression is None, otherwise compressed with 'zlib' at the given level,
+    using the dictionary if there is one.  Documents that don't get any
+    smaller are stored uncompressed.
+    '''
+    def __init__(self, compression=None, level=6, dictionary=None, format='json'):
+        assert compression in (None, 'zlib')
+        self.compression = compression
+        self.format = format
+        self.adapter = FORMATS[format]
+        self.level = level
+        self.dictionary_id = None
+        self.header = DEFLATE
+        self.compress = None
+        if compression and dictionary:
+            self.dictionary_id = add_dictionary(dictionary)
+            self.header = DEFLATE_DICTIONARY + struct.pack('>I', self.dictionary_id)
+            # primed like the decompressors, see add_dictionary()
+            self.compress = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self.compress.compress(dictionary)
+            self.compress.flush(zlib.Z_SYNC_FLUSH)
+
+    def encode(self, dictionary):
+        data = self.adapter(dictionary)
+        if self.compression is None:
+            return data
+        if self.compress is None:
+            compress = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        else:
+            compress = self.compress.copy()
+        compressed = compress.compress(data) + compress.flush()
+        if len(compressed) + len(self.header) >= len(data):
+            return data
+        return buffer(self.header + compressed)
+
+# the keys, strings and other values of a JSON document
+_FRAGMENTS = re.compile(r'"(?:[^"\\]|\\.)*":?|[^"{}\[\],:]+')
+
+def _fragments(document):
+    if document[:1] == BINARY:
+        # the opcodes (with their arguments) of the pickle, long enough to
+        # be worth referring back to
+        ops = [pos for opcode, arg, pos in pickletools.genops(document)] + [len(document)]
+        return [document[start:end] for start, end in itertools.izip(ops, ops[1:]) if end - start > 2]
+    return _FRAGMENTS.findall(document)
+
+def train_dictionary(documents, size=16384):
+    '''
+    Returns a dictionary for compressing documents like the given encoded
+    (uncompressed) documents: the fragments found in more than one of them,
+    up to size bytes, those that would save the most last (where references
+    to them are shortest).  A document can only refer back 32k, so the
+    dictionary should leave room for the documents.
+    '''
+    counts = defaultdict(int)
+    for document in documents:
+        for fragment in set(_fragments(document)):
+            counts[fragment] += 1
+    common = sorted(((count * len(fragment), fragment)
+        for fragment, count in counts.iteritems() if count > 1), reverse=True)
+    fragments = []
+    for saved, fragment in common:
+        if len(fragment) > size:
+            continue
+        size -= len(fragment)
+        fragments.append(fragment)
+    fragments.reverse()
+    return ''.join(fragments)
 
 sqlite3.register_adapter(dict, json_adapter)
 # we may not want to decode on read... save that for the final client
-sqlite3.register_converter('JSON', json_converter)
+sqlite3.register_converter('JSON', document_converter)
 sqlite3.register_converter('BLOB', str)
@@ -0,0 +1,28 @@
+
+'''
+The storage backends that tables can be kept in, chosen per table with the
+BACKEND configuration option.  Each backend opens a table as an adapter
+following table.BaseTableAdapter.
+'''
+
+import os
+
+from .lib.memory import MemoryTableAdapter
+from .lib.table import TableAdapter
+
+def _sqlite(config, table, readonly):
+    return TableAdapter(os.path.join(config.PATH, table + '.sqlite'), table, config, readonly)
+
+def _memory(config, table, readonly):
+    # there's nothing to share with read-only processors
+    assert not readonly
+    return MemoryTableAdapter(table, config, os.path.join(config.PATH, table + '.sqlite'))
+
+BACKENDS = {
+    'sqlite': _sqlite,
+    'memory': _memory,
+}
+
+def open_table(config, table, readonly=False):
+    assert config.BACKEND in BACKENDS
+    return BACKENDS[config.BACKEND](config, table, readonly)
@@ -0,0 +1,274 @@
+
+'''
+Online backups of a table's database file.  The backup reads the table in
+one transaction, so that it copies the table as it was when the backup
+started, and copies it a batch of rows at a time, so that the processor can
+keep handling requests in between.
+
+Compactions are backups to a new file that replaces the table's own file,
+once the documents written and deleted during the copy have been brought
+over too.
+'''
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _replace(tmp, path):
+    # the journal of whatever was there before doesn't belong to the new file
+    for suffix in ('-journal', '-wal', '-shm'):
+        _remove(path + suffix)
+    os.rename(tmp, path)
+
+class Backup(object):
+    '''
+    Copies the tables of the database in dbfile to a new file, then creates
+    their indexes, and the new file replaces path once it is complete.
+
+    The backup holds a read transaction open between steps, so the table
+    must be in wal mode for the processor to write in between (the
+    write-ahead log isn't checkpointed past the backup until it is done).
+    '''
+    def __init__(self, dbfile, path):
+        self.dbfile = dbfile
+        self.path = path
+        self.tmp = path + '.backup'
+        self.source = self.dest = None
+        self.tables = None
+        self.rows = None
+        self.insert = None
+        self.started = time.time()
+        self.total_pages = None
+        self.pages = 0
+        self.copied = 0
+        self.indexes = None
+        self.builder = None
+        self.error = None
+
+    def _start(self):
+        # the copy is of the table as it is when the first step is taken
+        _remove(self.tmp)
+        self.source = sqlite3.connect(self.dbfile, isolation_level=None)
+        self.source.text_factory = str
+        self.source.execute('BEGIN')
+        self.reading = True
+        schema = list(self.source.execute('''
+            SELECT type, name, sql FROM sqlite_master
+                WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' '''))
+        self.tables = [name for type, name, sql in schema if type == 'table']
+        # created once the rows have been copied, see _build_indexes()
+        self.indexes = [sql for type, name, sql in schema if type == 'index']
+        self.total_pages = self.source.execute('PRAGMA page_count').fetchone()[0]
+        self.dest = sqlite3.connect(self.tmp, isolation_level=None)
+        self.dest.text_factory = str
+        for pragma, value in self._pragmas():
+            self.dest.execute('PRAGMA %s = %i'%(pragma, value))
+        # an unfinished backup is thrown away, so it doesn't need a journal
+        self.dest.execute('PRAGMA journal_mode = off')
+        self.dest.execute('BEGIN')
+        for type, name, sql in schema:
+            if type == 'table':
+                self.dest.execute(sql)
+        self.dest.execute('COMMIT')
+
+    def _pragmas(self):
+        # the file format options of the copy
+        for pragma in ('page_size', 'auto_vacuum'):
+            yield pragma, self.source.execute('PRAGMA %s'%(pragma,)).fetchone()[0]
+
+    def deleted(self, rowid):
+        # called with the rowid of every document deleted during the backup
+        pass
+
+    def step(self, count):
+        '''
+        Copies up to count more rows, returning how many; 0 once everything
+        has been copied.
+        '''
+        if self.source is None:
+            self._start()
+        copied = 0
+        self.dest.execute('BEGIN')
+        while copied < count and self.tables:
+            if self.rows is None:
+                self.rows = self.source.execute('SELECT * FROM %s'%(self.tables[0],))
+                self.insert = 'INSERT INTO %s VALUES (%s)'%(
+                    self.tables[0], ', '.join(len(self.rows.description)*['?']))
+            batch = self.rows.fetchmany(min(count - copied, 10000))
+            if not batch:
+                self.tables.pop(0)
+                self.rows = None
+                continue
+            self.dest.executemany(self.insert, batch)
+            copied += len(batch)
+        self.dest.execute('COMMIT')
+        if not self.tables and self.reading:
+            # done reading
+            self.source.execute('ROLLBACK')
+            self.reading = False
+        self.copied += copied
+        self.pages = self.dest.execute('PRAGMA page_count').fetchone()[0]
+        if copied:
+            return copied
+        return self._build_indexes()
+
+    def _build_indexes(self):
+        # Like VACUUM, the indexes are created from the copied rows, rather
+        # than have every batch inserted into them.  That can take a while,
+        # so it is done by a thread with its own connection (sqlite releases
+        # the GIL), which each step waits on for a moment.  Returns 1 while
+        # the indexes are being created, 0 once they have been.
+        if self.builder is None:
+            self.builder = threading.Thread(target=self._create_indexes)
+            self.builder.daemon = True
+            self.builder.start()
+        self.builder.join(.01)
+        if self.builder.is_alive():
+            return 1
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return 0
+
+    def _create_indexes(self):
+        try:
+            db = sqlite3.connect(self.tmp, isolation_level=None)
+            try:
+                db.execute('PRAGMA journal_mode = off')
+                db.execute('BEGIN')
+                for sql in self.indexes:
+                    db.execute(sql)
+                db.execute('COMMIT')
+            finally:
+                db.close()
+        except:
+            self.error = sys.exc_info()
+
+    def progress(self):
+        # pages of the source table versus pages written so far
+        # (as of the last step, the copy may be busy creating its indexes)
+        pages = self.pages
+        eta = None
+        if pages:
+            eta = max(self.total_pages - pages, 0) * (time.time() - self.started) / pages
+        return {'path': self.path, 'done': self.copied, 'pages': pages,
+            'total_pages': self.total_pages, 'eta': eta}
+
+    def finish(self):
+        self.source.close()
+        self.dest.close()
+        _replace(self.tmp, self.path)
+
+    def close(self):
+        if self.source is not None:
+            if self.builder is not None:
+                # (it can't be interrupted)
+                self.builder.join()
+            self.source.close()
+            self.dest.close()
+            _remove(self.tmp)
+
+class Compaction(Backup):
+    '''
+    Rebuilds the table's file without fragmentation or free pages, with the
+    BLOCK_SIZE and AUTOVACUUM of the configuration.  Once the copy is made,
+    each step copies over the documents written since the last step (by
+    their last_updated), and those deleted (which must be passed to
+    deleted()), along with their rows in index_tables.  The step that finds
+    nothing left to copy leaves the copy ready for finish(), which must be
+    called before anything else is written, with the table's connection
+    closed.  Index rows written by anything else (index builds and deletes)
+    aren't copied over.
+    '''
+    def __init__(self, dbfile, index_tables, config):
+        Backup.__init__(self, dbfile, dbfile)
+        self.tmp = dbfile + '.compact'
+        self.index_tables = index_tables
+        self.config = config
+        self.live = None
+        self.watermark = None
+        self.dirty = set()
+        self.copying = True
+
+    def _start(self):
+        Backup._start(self)
+        # documents written after the copy was started are caught up on
+        self.watermark = self.source.execute('SELECT MAX(last_updated) FROM _data').fetchone()[0] or 0
+        # a plain connection to the table, so that values are copied as is
+        self.live = sqlite3.connect(self.dbfile)
+        self.live.text_factory = str
+
+    def _pragmas(self):
+        return [('page_size', self.config.BLOCK_SIZE), ('auto_vacuum', self.config.AUTOVACUUM)]
+
+    def deleted(self, rowid):
+        self.dirty.add(rowid)
+
+    def step(self, count):
+        '''
+        Copies up to count more rows, or once the copy has been made, catches
+        up on up to count more documents.  Returns how many; 0 once the copy
+        is up to date.
+        '''
+        if self.copying:
+            copied = Backup.step(self, count)
+            if copied:
+                return copied
+            self.copying = False
+        # (there's a limit on the number of parameters to a query)
+        count = min(count, 500)
+        # Deleted documents go first, so that a document deleted and written
+        # again with the same _id is deleted from the copy before it is
+        # copied over again.
+        rowids = set()
+        while self.dirty and len(rowids) < count:
+            rowids.add(self.dirty.pop())
+        if len(rowids) < count:
+            rows = self.live.execute('''
+                SELECT rowid, last_updated FROM _data
+                    WHERE last_updated > ? ORDER BY last_updated LIMIT ?''',
+                (self.watermark, count - len(rowids))).fetchall()
+            if rows:
+                self.watermark = rows[-1][1]
+            rowids.update(rowid for rowid, last_updated in rows)
+        if not rowids:
+            return 0
+        # replace the copy's version of the documents and their index rows
+        rowids = list(rowids)
+        marks = ', '.join(len(rowids)*['?'])
+        self.dest.execute('BEGIN')
+        tables = [('_data', 'rowid', 'rowid, _id, data, last_updated')]
+        # (index rows get new rowids, those of the table may have been reused)
+        tables += [(table, 'rowref', 'idata, rowref') for table in self.index_tables]
+        for table, column, columns in tables:
+            where = ' WHERE %s IN (%s)'%(column, marks)
+            self.dest.execute('DELETE FROM %s%s'%(table, where), rowids)
+            self.dest.executemany('INSERT INTO %s (%s) VALUES (%s)'%(
+                table, columns, ', '.join(len(columns.split(','))*['?'])),
+                self.live.execute('SELECT %s FROM %s%s'%(columns, table, where), rowids))
+        self.dest.execute('COMMIT')
+        self.copied += len(rowids)
+        return len(rowids)
+
+    def finish(self):
+        # the flags of the indexes may have changed
+        self.dest.execute('BEGIN')
+        self.dest.execute('DELETE FROM _indexes')
+        cur = self.live.execute('SELECT * FROM _indexes')
+        self.dest.executemany('INSERT INTO _indexes VALUES (%s)'%(
+            ', '.join(len(cur.description)*['?']),), cur)
+        self.dest.execute('COMMIT')
+        self.live.close()
+        Backup.finish(self)
+
+    def close(self):
+        if self.live is not None:
+            self.live.close()
+        Backup.close(self)
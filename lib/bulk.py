@@ -0,0 +1,156 @@
+
+'''
+Builds a new index over a table's existing documents in bulk.  Rather than
+indexing a few documents at a time with scattered inserts, the index rows for
+every document written before the build started are generated, sorted in
+bounded memory (spilling sorted runs to temporary files), then merged and
+inserted in key order.
+'''
+
+import heapq
+import itertools
+import marshal
+import tempfile
+
+from .lib.exceptions import PackError
+from .lib.pack import generate_index_rows
+
+# how many index rows to marshal at a time in a sorted run
+CHUNK_SIZE = 1000
+
+def _write_run(items, path):
+    items.sort()
+    f = tempfile.TemporaryFile(dir=path)
+    for i in xrange(0, len(items), CHUNK_SIZE):
+        marshal.dump(items[i:i+CHUNK_SIZE], f)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    while 1:
+        try:
+            chunk = marshal.load(f)
+        except EOFError:
+            return
+        for item in chunk:
+            yield item
+
+class BulkIndexBuild(object):
+    '''
+    Documents with a last_updated up to the watermark are indexed by the
+    build, those written afterwards are indexed as they are written.  The
+    rowids of documents that are updated or deleted during the build must be
+    added to dirty, so
+    that the (possibly stale) index rows generated for them are skipped, and
+    their index rows are checked once the build is done.  Index rows are
+    written with insert(rows, cursor), and with a KeyPool, they are generated
+    by its workers.
+    '''
+    def __init__(self, index_id, columns, watermark, config, path, insert, keys=None):
+        self.index_id = index_id
+        self.index_dict = {columns: index_id}
+        self.watermark = watermark
+        self.config = config
+        self.path = path
+        self.insert = insert
+        self.keys = keys
+        self.position = -2**63
+        self.buffer = []
+        self.runs = []
+        self.merged = None
+        self.last = None
+        self.dirty = set()
+        self.multi = set()
+        self.scanned = 0
+        # the documents to scan, counted once
+        self.documents = None
+        self.generated = 0
+        self.inserted = 0
+
+    def _generate(self, data):
+        try:
+            return generate_index_rows(data, self.index_dict, self.config, multi=self.multi)
+        except PackError:
+            # the document couldn't have been written with this index
+            return None
+
+    def step(self, cursor, count):
+        '''
+        Scans up to count more documents, or once they have all been scanned,
+        inserts up to count more index rows.  Returns the number of documents
+        or index rows handled, and whether any index rows were inserted; 0
+        once all of the index rows have been inserted.
+        '''
+        if self.merged is None:
+            rows = list(cursor.execute('''
+                SELECT rowid, _id, data, last_updated
+                    FROM _data
+                    WHERE last_updated > ? AND last_updated <= ?
+                    ORDER BY last_updated
+                    LIMIT %i''' % (count,), (self.position, self.watermark)))
+            docs = []
+            for rowid, _id, data, last_updated in rows:
+                data['_id'] = _id
+                docs.append(data)
+            if self.keys is not None and len(docs) >= self.config.KEY_POOL_THRESHOLD:
+                generated = self.keys.generate(docs, self.index_dict, self.multi, True)
+            else:
+                generated = map(self._generate, docs)
+            for row, gen in itertools.izip(rows, generated):
+                if gen is not None:
+                    self.buffer.extend((str(key), row[0]) for key in gen[1])
+            self.scanned += len(rows)
+            if rows:
+                self.position = rows[-1][3]
+                if len(self.buffer) >= self.config.BULK_INDEX_RUN_SIZE:
+                    self.generated += len(self.buffer)
+                    self.runs.append(_write_run(self.buffer, self.path))
+                    self.buffer = []
+                return len(rows), False
+            # everything has been scanned, merge the runs
+            self.generated += len(self.buffer)
+            self.buffer.sort()
+            self.merged = heapq.merge(self.buffer, *map(_read_run, self.runs))
+
+        handled = 0
+        batch = []
+        for item in itertools.islice(self.merged, count):
+            handled += 1
+            if item == self.last or item[1] in self.dirty:
+                continue
+            self.last = item
+            batch.append(item)
+        self.insert(batch, cursor)
+        self.inserted += handled
+        return handled, bool(batch)
+
+    def remaining(self, cursor):
+        # documents left to scan, plus index rows left to insert
+        if self.merged is not None:
+            return self.generated - self.inserted
+        if self.documents is None:
+            self.documents = self.scanned + cursor.execute('''
+                SELECT count(*) FROM _data WHERE last_updated > ? AND last_updated <= ?''',
+                (self.position, self.watermark)).fetchone()[0]
+        return self.generated + len(self.buffer) + max(self.documents - self.scanned, 0)
+
+    def finish(self, cursor, existing):
+        '''
+        Adds any index rows missing for documents that were changed during
+        the build, existing(rowid, cursor) returns the keys of a document's
+        index rows.
+        '''
+        for rowid in self.dirty:
+            for _id, data in cursor.execute('SELECT _id, data FROM _data WHERE rowid = ?', (rowid,)).fetchall():
+                data['_id'] = _id
+                generated = self._generate(data)
+                keys = set(map(str, generated[1] if generated else ()))
+                keys.difference_update(existing(rowid, cursor))
+                self.insert([(key, rowid) for key in keys], cursor)
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+        self.buffer = []
+        self.merged = None
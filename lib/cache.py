@@ -0,0 +1,95 @@
+
+'''
+A size-bounded least-recently-used cache.
+'''
+
+PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+class LRUCache(object):
+    '''
+    Caches up to max_entries items, and up to max_size of their estimated
+    sizes, evicting the least recently used items first.  A limit of 0 is no
+    limit.  Hits, misses and evictions are counted for reporting.
+    '''
+    def __init__(self, max_entries=0, max_size=0):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        # The entries form a circular doubly-linked list through the root,
+        # with the least recently used entry at root[NEXT].
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+        self.entries = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _link(self, entry):
+        root = self.root
+        last = root[PREV]
+        entry[PREV] = last
+        entry[NEXT] = root
+        last[NEXT] = root[PREV] = entry
+
+    def get(self, key, default=None, valid=None):
+        # If provided, valid(value) decides whether an entry can still be used.
+        entry = self.entries.get(key)
+        if entry is not None and valid is not None and not valid(entry[VALUE]):
+            self._remove(entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(entry)
+        self._link(entry)
+        return entry[VALUE]
+
+    def put(self, key, value, size=0):
+        self.discard(key)
+        if self.max_size and size > self.max_size:
+            # would evict everything else and still not fit
+            return
+        entry = [None, None, key, value, size]
+        self._link(entry)
+        self.entries[key] = entry
+        self.size += size
+        root = self.root
+        while (self.max_entries and len(self.entries) > self.max_entries) or \
+                (self.max_size and self.size > self.max_size):
+            self._remove(root[NEXT])
+            self.evictions += 1
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry[KEY]]
+        self.size -= entry[SIZE]
+
+    def discard(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / requests if requests else 0.0,
+            'evictions': self.evictions,
+        }
@@ -4,6 +4,9 @@
 #-----------------------------------------------------------------------------
 # Where to store the data for YogaTable.
 PATH = '.'
+# The directory in PATH that a table's backup() writes to, kept apart from
+# the files of the tables.
+BACKUP_PATH = 'backups'
 # What port to listen on when using the server version of YogaTable
 PORT = 8765
 # What host to listen on when using the server version of YogaTable
@@ -16,6 +19,12 @@ DESIRED_LATENCY = .010
 # How long to wait until starting to perform maintence operations after
 # responding to queries.
 IDLE_TIMEOUT = .025
+# Building and deleting indexes (and taking backups and snapshots) gets at
+# least MAINTENANCE_TIME seconds out of every MAINTENANCE_PERIOD seconds, even
+# on a table that is never idle.  Use a MAINTENANCE_TIME of 0 to only do them
+# when idle.
+MAINTENANCE_TIME = .010
+MAINTENANCE_PERIOD = .100
 # How many responses to process per attempt to clean up old thread queues.
 THREAD_CLEANUP_RATE = 256
 
@@ -35,6 +44,100 @@ MAX_INDEX_ROW_LENGTH = 512
 # row itself.
 ROW_TOO_LONG = 'fail'
 
+# Whether new indexes get their own table, rather than sharing the _index
+# table.  Their keys are shorter, they are scanned without skipping over the
+# rows of other indexes, and dropping one is immediate.  Existing indexes keep
+# the layout that they were created with.
+INDEX_TABLES = False
+# Whether newly created index tables store their rows WITHOUT ROWID, in
+# (key, document) order, instead of as rows with separate indexes on both.
+# Index rows are then stored twice rather than three times.
+INDEX_WITHOUT_ROWID = False
+
+# Indexes added to tables with at least this many rows are built in bulk:
+# the index rows are generated for all of the existing rows, sorted (with up
+# to BULK_INDEX_RUN_SIZE index rows in memory at a time, the rest in sorted
+# temporary files next to the table), then inserted in order.  0 always
+# builds indexes a few rows at a time.
+BULK_INDEX_ROWS = 100000
+BULK_INDEX_RUN_SIZE = 200000
+
+# How many worker processes each table uses to generate index rows for
+# inserts of at least KEY_POOL_THRESHOLD documents, and for bulk index
+# builds.  Documents are handed to the workers KEY_CHUNK_SIZE at a time.  0
+# generates all index rows in the table's processor.
+KEY_WORKERS = 0
+KEY_POOL_THRESHOLD = 1000
+KEY_CHUNK_SIZE = 250
+
+# How many decoded documents to keep in each table's get() cache, and how
+# many bytes of (encoded) documents to keep there.  The cache is disabled when
+# both are 0, when one is 0, only the other limit applies.
+DOCUMENT_CACHE_ENTRIES = 0
+DOCUMENT_CACHE_BYTES = 0
+# How many search(), count() and exists() results to keep per table for
+# reuse until the table is next changed, 0 disables the cache.
+QUERY_CACHE_ENTRIES = 0
+
+# How documents are encoded as they are written: 'json', or 'binary', which
+# is several times faster to read and about twice as fast to write.  With
+# 'binary', values are read back with the types they were written with: str
+# stays str (rather than becoming unicode) and tuples stay tuples (rather
+# than becoming lists).  Documents written in either format stay readable
+# whatever this is changed to, those already written are left as they are.
+# The format a table writes is recorded in the table.
+DOCUMENT_FORMAT = 'json'
+
+# How the documents of a table are compressed as they are written: None
+# stores them as plain JSON, 'zlib' compresses them at COMPRESSION_LEVEL (1-9).
+# Documents stay readable whatever this is changed to, those already written
+# are left as they are.  Only tables using the 'sqlite' BACKEND compress
+# documents.
+COMPRESSION = None
+COMPRESSION_LEVEL = 6
+# With COMPRESSION = 'zlib', how many of a table's documents to sample for a
+# dictionary of the keys and values they have in common, which all documents
+# written after it are compressed with.  Small documents compress much better
+# with one.  The dictionary is trained when the table is opened with at least
+# this many documents and no dictionary yet.  0 compresses documents without
+# a dictionary.
+COMPRESSION_DICTIONARY = 0
+
+# How many consecutive insert(), update() and delete() requests waiting for a
+# table can be committed together, and for how many seconds to keep adding
+# them to the transaction.  Each request still succeeds or fails on its own,
+# and is responded to once the transaction has been committed.  A size of 1
+# commits every request separately.
+GROUP_COMMIT_SIZE = 100
+GROUP_COMMIT_TIME = .010
+
+# How many requests can be waiting for each table processor, 0 is no limit.
+# When the queue is full, requests fail immediately with an Overloaded
+# exception.
+MAX_QUEUE_SIZE = 0
+# How many seconds requests can wait to be handled before failing with an
+# Overloaded exception, 0 is no limit.  Clients can override this per request
+# by passing _timeout=seconds as a keyword argument.
+REQUEST_TIMEOUT = 0
+
+# How many seconds a read, write or admin (index, drop table, ...) request
+# should wait at most before being handled, requests are handled in the order
+# of these deadlines.  Clients can choose the lane of a request by passing
+# _priority='read', 'write' or 'admin' as a keyword argument.
+LANE_LATENCY = {'read': .005, 'write': .050, 'admin': .500}
+# How many rows of a list passed to insert(), update() or delete() to commit
+# at a time, so that other requests can be handled between slices.  Each
+# slice then succeeds or fails on its own: when a slice fails, the earlier
+# slices stay committed and the rest are skipped.  0 commits the whole list
+# at once.
+MUTATION_SLICE_SIZE = 0
+
+# When using the embedded or server modules with JOURNAL_MODE = 'wal', how
+# many read-only processors to start per table in addition to the one that
+# performs writes.  Reads are spread over them round-robin, while writes and
+# maintenance are left to the writer.
+READ_WORKERS = 0
+
 # When using the embedded or server modules, what tables to automatically
 # start processors for at startup?
 # Used as:
@@ -46,6 +149,19 @@ AUTOLOAD_TABLES = []
 # TABLE_CONFIGURATION = {'table1': {'PATH':'/var/local/table1'}}
 TABLE_CONFIGURATION = {}
 
+# Where tables keep their data: 'sqlite' stores each table in PATH, while
+# 'memory' keeps it in the table's processor only, for ephemeral data that
+# needs low latency more than it needs to survive a restart.  Usually set per
+# table like: TABLE_CONFIGURATION = {'sessions': {'BACKEND':'memory'}}
+BACKEND = 'sqlite'
+# How many seconds after a snapshot of a 'memory' table was started to take
+# another one, if the table has changed since.  Snapshots are written to the
+# file the 'sqlite' backend would use, a few documents at a time when the
+# table is idle, and once more when the processor shuts down.  The table is
+# loaded from its last snapshot when its processor starts.  0 disables
+# snapshots, and leaves any existing file alone.
+SNAPSHOT_INTERVAL = 0
+
 
 # Note: try to keep MINIMUM_VACUUM_BLOCKS values reasonably low, it will
 # keep YogaTable responsive, even during cleanup.
@@ -63,6 +179,9 @@ MINIMUM_VACUUM_BLOCKS = 100
 # Note: when changing this for an existing table from 0 to 1/2 or from 1/2 to
 # 0, YogaTable will automatically vacuum the underlying SQLite database.
 # Don't change this for an existing table unless you know what you are doing.
+# A table's compact() operation applies a new AUTOVACUUM (and BLOCK_SIZE) to
+# it without blocking (with JOURNAL_MODE = 'wal'), change it after the table
+# has been compacted.
 # Also, as per http://www.sqlite.org/releaselog/3_7_2.html , using autovacuum
 # 2 may result in corruption, depending on your version of sqlite.
 AUTOVACUUM = 1
@@ -72,3 +191,19 @@ AUTOVACUUM = 1
 CACHE_SIZE = 2000
 # size of blocks in newly created tables
 BLOCK_SIZE = 8192
+# The journal mode to use, as per sqlite docs:
+# http://www.sqlite.org/pragma.html#pragma_journal_mode
+# Using 'wal' lets readers work while a write is in progress, and commits
+# with fewer fsyncs.  Write-ahead log checkpoints are also performed by the
+# processor when it is otherwise idle.
+JOURNAL_MODE = 'delete'
+# When sqlite should fsync, one of 'off', 'normal', 'full' or 'extra', as per
+# sqlite docs: http://www.sqlite.org/pragma.html#pragma_synchronous
+# With JOURNAL_MODE = 'wal', 'normal' is safe from corruption, but may lose
+# the most recent commits on power loss.
+SYNCHRONOUS = 'full'
+# With JOURNAL_MODE = 'wal', the number of pages the write-ahead log can grow
+# to before a commit will checkpoint it; 0 leaves checkpoints to idle time.
+WAL_AUTOCHECKPOINT = 1000
+# How many bytes of the table to memory map, 0 disables memory mapping.
+MMAP_SIZE = 0
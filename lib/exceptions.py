@@ -40,6 +40,9 @@ class InvalidOperation(YogaTableException):
 class UnknownExceptionError(YogaTableException):
     pass
 
+class Overloaded(YogaTableException):
+    pass
+
 
 class BadResponseCode(YogaTableException):
     pass
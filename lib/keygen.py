@@ -0,0 +1,101 @@
+
+'''
+Generates the index rows for many documents at once over a pool of worker
+processes, so that large inserts and bulk index builds aren't limited to the
+one core of their table's processor.  Only the key generation is handed out,
+the SQLite writes stay with the table's processor.
+'''
+
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+from .lib.exceptions import PackError
+from .lib.pack import generate_index_rows
+
+# the configuration generate_index_rows() uses, config modules can't be
+# pickled so these are sent along with each chunk of documents
+_CONFIG_NAMES = ('MAX_INDEX_ROW_COUNT', 'MAX_INDEX_ROW_LENGTH', 'TOO_MANY_ROWS', 'ROW_TOO_LONG')
+
+class _Config(object):
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+def _watch_parent(parent):
+    # a table processor that is killed can't clean up its pool
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+def _init_worker(parent):
+    watcher = threading.Thread(target=_watch_parent, args=(parent,))
+    watcher.daemon = True
+    watcher.start()
+
+def _generate(args):
+    docs, index_dict, values, skip_invalid, swapped = args
+    config = _Config(values)
+    out = []
+    for data in docs:
+        multi = set()
+        try:
+            count, rows = generate_index_rows(data, index_dict, config, multi=multi, swapped=swapped)
+        except PackError:
+            if not skip_invalid:
+                raise
+            out.append(None)
+            continue
+        # buffers can't be pickled
+        out.append((count, map(str, rows), multi))
+    return out
+
+class KeyPool(object):
+    '''
+    A pool of config.KEY_WORKERS processes, started the first time that
+    documents are handed to it.  Documents are sent in chunks of
+    config.KEY_CHUNK_SIZE.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.values = dict((name, getattr(config, name)) for name in _CONFIG_NAMES)
+        self.pool = None
+
+    def generate(self, docs, index_dict, multi=None, skip_invalid=False, swapped=()):
+        '''
+        Returns (row count, index rows) for each of the documents, like
+        generate_index_rows().  With skip_invalid, documents that can't be
+        packed get None instead of raising a PackError.
+        '''
+        if self.pool is None:
+            current = multiprocessing.current_process()
+            # Table processors are daemons, which aren't allowed to start
+            # processes of their own, so they only stop being one while the
+            # pool starts.  The pool's workers are daemons, stopped by close()
+            # when the processor exits, or by the processor's own exit.
+            daemon = current.daemon
+            current.daemon = False
+            try:
+                self.pool = multiprocessing.Pool(self.config.KEY_WORKERS, _init_worker, (os.getpid(),))
+            finally:
+                current.daemon = daemon
+        size = self.config.KEY_CHUNK_SIZE
+        chunks = [(docs[i:i+size], index_dict, self.values, skip_invalid, swapped)
+            for i in xrange(0, len(docs), size)]
+        out = []
+        for result in itertools.chain.from_iterable(self.pool.map(_generate, chunks)):
+            if result is None:
+                out.append(None)
+                continue
+            count, rows, doc_multi = result
+            if multi is not None:
+                multi.update(doc_multi)
+            out.append((count, map(buffer, rows)))
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,427 @@
+
+'''
+A table that only lives in the memory of its processor, for ephemeral,
+cache-like data that needs low latency more than it needs to survive a
+restart.  Documents are kept encoded in a dict by _id, and the index rows of
+every index are kept in one sorted list of (key, _id) pairs, which is
+searched with bisect.
+
+With SNAPSHOT_INTERVAL, the table is snapshotted to the file a 'sqlite'
+table would use, and loaded from it when its processor starts.
+'''
+
+from __future__ import with_statement
+
+import bisect
+from contextlib import contextmanager
+import heapq
+import itertools
+import os
+import sqlite3
+import time
+
+from .lib.adapt import Codec, decompress, document_converter
+from .lib.backup import _remove, _replace
+from .lib.exceptions import PackError, TableIndexError
+from .lib.om import DataTable, DictionaryTable, IndexInfo, MetadataTable, _time_seq
+from .lib.pack import generate_index_rows, pack
+from .lib.table import BaseTableAdapter, TableAdapter, _add_one, \
+    _apply_update, _disjunction, _order_key, _parse_limit, new_uuid
+
+class Snapshot(object):
+    '''
+    Writes the documents and index definitions of a table, as they were when
+    the snapshot was started, to a new file with the layout of a 'sqlite'
+    table, which replaces the previous snapshot once it is complete.  Index
+    rows aren't written, indexes are rebuilt from the documents when the
+    snapshot is loaded.
+    '''
+    def __init__(self, path, rows, indexes, config):
+        self.path = path
+        self.tmp = path + '.snapshot'
+        _remove(self.tmp)
+        # [(_id, (encoded document, index keys)), ...]
+        self.rows = rows
+        self.written = 0
+        self.db = sqlite3.connect(self.tmp)
+        # an unfinished snapshot is thrown away, so it doesn't need a journal
+        self.db.execute('PRAGMA journal_mode = off')
+        self.db.execute('PRAGMA page_size = %i'%(config.BLOCK_SIZE,))
+        self.db.execute('PRAGMA auto_vacuum = %i'%(config.AUTOVACUUM,))
+        info = IndexInfo(self.db)
+        DataTable(self.db)
+        metadata = MetadataTable(self.db)
+        with self.db as cursor:
+            metadata.set('format', config.DOCUMENT_FORMAT, conn=cursor)
+            # the indexes are current, see TableAdapter._upgrade()
+            metadata.set('multiple_flagged', '1', conn=cursor)
+            for index_id, index_def in indexes:
+                # a 'sqlite' table opening the snapshot builds them itself,
+                # flagging those that turn out to have multiple rows
+                info.insert((index_id, index_def, 0, 0), conn=cursor)
+
+    def step(self, count):
+        # writes up to count more documents, returning how many
+        rows = self.rows[self.written:self.written + count]
+        with self.db as cursor:
+            cursor.executemany('INSERT INTO _data (_id, data, last_updated) VALUES (?, ?, ?)',
+                ((_id, buffer(row[0]), t) for (_id, row), t in itertools.izip(rows, _time_seq())))
+        self.written += len(rows)
+        return len(rows)
+
+    def finish(self):
+        self.db.close()
+        _replace(self.tmp, self.path)
+
+    def close(self):
+        self.db.close()
+        _remove(self.tmp)
+
+class MemoryTableAdapter(BaseTableAdapter):
+    '''
+    Indexes are built as soon as they are added, and removed as soon as they
+    are dropped.  Changes made by a list passed to insert(), update() or
+    delete(), or by a request of a group commit, are undone if it fails.
+    '''
+    def __init__(self, tablename, config, dbfile=None):
+        self.config = config
+        self.table = tablename
+        self.dbfile = dbfile
+        self.drop_key = object()
+        self.codec = Codec(format=config.DOCUMENT_FORMAT)
+        self._snapshot = None
+        self._clear()
+        if dbfile and config.SNAPSHOT_INTERVAL and os.path.exists(dbfile):
+            self._load()
+
+    def _clear(self):
+        # whether anything changed since the last snapshot was started, and
+        # when that was
+        self._dirty = False
+        self._snapshot_time = time.time()
+        self._last_snapshot = None
+        # _id -> (encoded document, index keys)
+        self.rows = {}
+        self.keys = []
+        self.known_indexes = []
+        self.indexes_to_ids = {}
+        self.next_index_id = 0
+        # (_id, old row) for every change since the outermost _transaction()
+        self._undo = None
+
+    @contextmanager
+    def _transaction(self):
+        # Changes made inside are undone when it raises, like a savepoint.
+        outer = self._undo is None
+        if outer:
+            self._undo = []
+        mark = len(self._undo)
+        try:
+            yield
+        except:
+            undo = self._undo
+            while len(undo) > mark:
+                args = undo.pop()
+                self._set_row(*args, record=False)
+            raise
+        finally:
+            if outer:
+                self._undo = None
+
+    def _set_row(self, _id, row, record=True):
+        # replaces the (encoded document, index keys) for _id, None deletes
+        self._dirty = True
+        old = self.rows.pop(_id, None)
+        if record and self._undo is not None:
+            self._undo.append((_id, old))
+        keys = self.keys
+        if old is not None:
+            for key in old[1]:
+                del keys[bisect.bisect_left(keys, (key, _id))]
+        if row is not None:
+            self.rows[_id] = row
+            for key in row[1]:
+                bisect.insort(keys, (key, _id))
+
+    def _row(self, data, keys):
+        # the row for a document (without its _id) and its index rows
+        return str(self.codec.encode(data)), sorted(set(map(str, keys)))
+
+    def info(self):
+        return {
+            'backend': 'memory',
+            'indexes': self.known_indexes,
+            'indexes_del': [],
+            'indexes_add': [],
+            'documents': len(self.rows),
+            'format': self.config.DOCUMENT_FORMAT,
+            'index_rows': len(self.keys),
+            'document_cache': None,
+            'index_build': None,
+            'index_bulk_build': None,
+            'index_delete': None,
+            'last_snapshot': self._last_snapshot,
+            'snapshot': self._snapshot and
+                {'documents': len(self._snapshot.rows), 'written': self._snapshot.written},
+        }
+
+    def insert(self, data, cursor=None):
+        '''
+        Inserts one or more rows, returning (uuid, total index rows, number of
+        inserted index rows) for each of them.
+
+        All rows will be inserted, or no rows will be inserted.
+        '''
+        if isinstance(data, list):
+            with self._transaction():
+                return [self.insert(drow) for drow in data]
+        count, keys = generate_index_rows(data, self.indexes_to_ids, self.config)
+        if '_id' not in data:
+            data['_id'] = new_uuid()
+        _id = data.pop('_id')
+        if _id in self.rows:
+            raise ValueError("Document with _id %r already exists" % (_id,))
+        self._set_row(_id, self._row(data, keys))
+        return _id, count, len(keys)
+
+    def delete(self, id, cursor=None):
+        '''
+        Deletes one or more rows by uuid.
+        '''
+        if isinstance(id, list):
+            with self._transaction():
+                return map(self.delete, id)
+        if id in self.rows:
+            self._set_row(id, None)
+
+    def update(self, data, cursor=None, index_only=False, shared=None):
+        '''
+        Updates row or rows provided.  All are updated, or none are updated.
+        '''
+        if shared is None:
+            shared = {}
+        if isinstance(data, list):
+            with self._transaction():
+                return [self.update(drow, shared=shared) for drow in data]
+
+        rowref = data.pop('_id')
+        row = self.rows.get(rowref)
+        data = _apply_update(document_converter(row[0]) if row else {}, data, shared)
+        if row is not None:
+            count, keys = generate_index_rows(data, self.indexes_to_ids, self.config)
+            self._set_row(rowref, self._row(data, keys))
+        data['_id'] = rowref
+        return data
+
+    def get(self, id, cursor=None):
+        '''
+        Gets a row or rows from the provided id or ids.
+        '''
+        if isinstance(id, list):
+            return map(self.get, id)
+        row = self.rows.get(id)
+        if row is not None:
+            data = document_converter(row[0])
+            data['_id'] = id
+            return data
+
+    def _group_commit(self, requests):
+        results = []
+        for operation, args, kwargs in requests:
+            try:
+                with self._transaction():
+                    value = getattr(self, operation)(*args, **kwargs)
+            except Exception as e:
+                results.append((None, e))
+            else:
+                results.append((value, None))
+        return results
+
+    def add_index(self, *columns):
+        '''
+        Adds an index on the provided columns, indexing the existing rows.
+        '''
+        index_def = self._new_index_def(columns)
+        if index_def not in self.indexes_to_ids:
+            self._add_index_def(index_def)
+
+    def _add_index_def(self, index_def):
+        index = {index_def: self.next_index_id}
+        added = []
+        for _id, (encoded, keys) in self.rows.iteritems():
+            try:
+                count, new_keys = generate_index_rows(document_converter(encoded), index, self.config)
+            except PackError:
+                # the document couldn't have been written with this index
+                continue
+            new_keys = set(map(str, new_keys))
+            keys.extend(new_keys)
+            keys.sort()
+            added.extend((key, _id) for key in new_keys)
+        # one sort, rather than an insort per index row
+        self.keys.extend(added)
+        self.keys.sort()
+        self.indexes_to_ids.update(index)
+        self.next_index_id += 1
+        bisect.insort(self.known_indexes, index_def)
+        self._dirty = True
+
+    def drop_index(self, *columns):
+        '''
+        Removes the given index if it exists.
+        '''
+        index_def = self._col_def(columns)
+        index_id = self.indexes_to_ids.pop(index_def, None)
+        if index_id is None:
+            return
+        self.known_indexes.remove(index_def)
+        self._dirty = True
+        start = pack(index_id)[1:]
+        end = pack(index_id+1)[1:]
+        keys = self.keys
+        del keys[bisect.bisect_left(keys, (start,)):bisect.bisect_left(keys, (end,))]
+        for _id, (encoded, row_keys) in self.rows.iteritems():
+            row_keys[:] = [key for key in row_keys if not start <= key < end]
+
+    def drop_table(self, key):
+        '''
+        Drops the table if the proper key is provided.
+        '''
+        if key == self.drop_key:
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
+            if self.dbfile and self.config.SNAPSHOT_INTERVAL:
+                for suffix in ('', '-journal', '-wal', '-shm'):
+                    _remove(self.dbfile + suffix)
+            self._clear()
+            return True
+        return False
+
+    def _load(self):
+        # Restores the documents and indexes of the last snapshot, or of a
+        # table that used to be stored by the 'sqlite' backend.
+        db = sqlite3.connect(self.dbfile)
+        db.text_factory = str
+        try:
+            # documents the 'sqlite' backend compressed are kept uncompressed
+            DictionaryTable(db).load()
+            for _id, data in db.execute('SELECT _id, data FROM _data'):
+                self.rows[_id] = (decompress(data), [])
+            indexes = list(db.execute('SELECT columns FROM _indexes WHERE flags & ? = 0 ORDER BY index_id',
+                (TableAdapter.INDEX_FLAGS.deleting,)))
+        finally:
+            db.close()
+        for index_def, in indexes:
+            self._add_index_def(index_def)
+        self._dirty = False
+
+    def _snapshot_due(self, force=False):
+        interval = self.config.SNAPSHOT_INTERVAL
+        if self._snapshot is not None:
+            return True
+        return bool(self.dbfile and interval and self._dirty and
+            (force or time.time() - self._snapshot_time >= interval))
+
+    def _snapshot_some(self, count):
+        '''
+        Writes up to count documents of the current snapshot, starting one if
+        there is none.  Returns how many were written, 0 once the snapshot has
+        replaced the last one.
+        '''
+        if self._snapshot is None:
+            self._dirty = False
+            self._snapshot_time = time.time()
+            indexes = sorted((index_id, index_def) for index_def, index_id in self.indexes_to_ids.iteritems())
+            self._snapshot = Snapshot(self.dbfile, self.rows.items(), indexes, self.config)
+        written = self._snapshot.step(count)
+        if not written:
+            self._snapshot.finish()
+            self._snapshot = None
+            self._last_snapshot = self._snapshot_time
+        return written
+
+    def _flush(self):
+        # finishes the current snapshot, and takes another if anything has
+        # changed since it started
+        while self._snapshot_due(True):
+            self._snapshot_some(10000)
+
+    def _scan(self, filters, order):
+        # The _ids of the rows in the index range for the filters, in index
+        # order, each only once.
+        index_id, reverse, lower, upper, upper_op = self._key_range(filters, order)
+        prefix = pack(index_id)[1:]
+        keys = self.keys
+        start = bisect.bisect_left(keys, (prefix + lower,))
+        if upper is None:
+            end = bisect.bisect_left(keys, (_add_one(prefix),))
+        elif upper_op == '<':
+            end = bisect.bisect_left(keys, (prefix + upper,))
+        else:
+            # the first key after upper
+            end = bisect.bisect_left(keys, (prefix + upper + '\0',))
+        positions = xrange(end - 1, start - 1, -1) if reverse else xrange(start, end)
+        def ids():
+            seen = set()
+            for i in positions:
+                _id = keys[i][1]
+                if _id not in seen:
+                    seen.add(_id)
+                    yield _id
+        return ids()
+
+    def _documents(self, ids):
+        return itertools.imap(self.get, ids)
+
+    def _search_rows(self, filters, order, limit, sort=False):
+        if sort and order and [f for f in filters if f[1] != '=']:
+            return self._search_top(filters, order, limit)
+        try:
+            ids = self._scan(filters, order)
+        except TableIndexError:
+            if not order:
+                raise
+            return self._search_top(filters, order, limit)
+        offset, limit = limit if isinstance(limit, tuple) else (0, limit)
+        return list(self._documents(itertools.islice(ids, offset, offset + limit)))
+
+    def _search_top(self, filters, order, limit):
+        offset, limit = limit if isinstance(limit, tuple) else (0, limit)
+        key = _order_key(order)
+        def keyed():
+            for data in self._documents(self._scan(filters, ())):
+                k = key(data)
+                if k is not None:
+                    yield k, data
+        out = heapq.nsmallest(offset + limit, keyed(), key=lambda row: row[0])
+        return [data for k, data in out[offset:]]
+
+    def count(self, filters, order=(), limit=None):
+        '''
+        Like search, only returning the total count (with an optional limit
+        clause).
+        '''
+        limit = _parse_limit(limit, True)
+        ids = set()
+        for branch in _disjunction(filters):
+            ids.update(self._scan(branch, order))
+        count = len(ids)
+        if isinstance(limit, tuple):
+            return max(min(limit[1], count - limit[0]), 0)
+        if limit:
+            return min(limit, count)
+        return count
+
+    def exists(self, filters):
+        '''
+        Returns whether any row matches the provided filters.
+        '''
+        for branch in _disjunction(filters):
+            if len(branch) == 1 and tuple(branch[0][:2]) == ('_id', '='):
+                if branch[0][2] in self.rows:
+                    return True
+                continue
+            for _id in self._scan(branch, ()):
+                return True
+        return False
@@ -53,16 +53,21 @@ def _where_clause(where, kwhere):
 
 class SQLTable(object):
     indexes = ()
+    # table constraints, and options like WITHOUT ROWID
+    constraints = ()
+    options = ''
     def __init__(self, db):
         self.db = db
         self.setup()
     def setup(self):
         self._cols = [colname.partition(' ')[0] for colname in self.columns]
+        self.create()
+    def create(self):
         columns = [colname + ' NOT NULL' if 'NOT NULL' not in colname else colname for colname in self.columns]
         self.db.execute('''
             CREATE TABLE IF NOT EXISTS
-                %s (%s);
-            '''%(self.table_name, ', '.join(columns)))
+                %s (%s)%s;
+            '''%(self.table_name, ', '.join(columns + list(self.constraints)), self.options))
         for name, cols, unique in self.indexes:
             self.db.execute('''
             CREATE %s INDEX IF NOT EXISTS
@@ -117,17 +122,41 @@ class IndexInfo(SQLTable):
     table_name = '_indexes'
 
 class IndexTable(SQLTable):
-    columns = 'rowid INTEGER PRIMARY KEY', 'idata BLOB', 'rowref TEXT'
+    # rowref is the rowid of the document in _data
+    columns = 'rowid INTEGER PRIMARY KEY', 'idata BLOB', 'rowref INTEGER'
     table_name = '_index'
     indexes = [
         ('_index_idata', ('idata',), False),
         ('_index_irowref', ('rowref',), False),
     ]
-    def __init__(self, db):
+    # the part of every key that isn't stored
+    prefix = ''
+    def __init__(self, db, clustered=False):
+        if clustered:
+            # When created, the rows are stored in (idata, rowref) order
+            # without a rowid, so the only other copy of them is the index
+            # on rowref.
+            self.columns = self.columns[1:]
+            self.constraints = ('PRIMARY KEY (idata, rowref)',)
+            self.options = ' WITHOUT ROWID'
+            self.indexes = [index for index in self.indexes if index[1] != ('idata',)]
         SQLTable.__init__(self, db)
         # We don't want to be inserting based on rowid, so we'll pretend it
         # doesn't exist from this side of things.
-        self._cols = self._cols[1:]
+        self._cols = [col for col in self._cols if col != 'rowid']
+    def insert_many(self, data, conn=None):
+        # A document can produce the same index row more than once, which a
+        # clustered table only keeps once.
+        conn = conn or self.db
+        return conn.executemany('''
+            INSERT OR IGNORE INTO %s (idata, rowref) VALUES (?, ?);
+            '''%(self.table_name,), data)
+    def delete_rows(self, rows, conn=None):
+        # deletes (idata, rowref) index rows
+        conn = conn or self.db
+        return conn.executemany('''
+            DELETE FROM %s WHERE idata = ? AND rowref = ?;
+            '''%(self.table_name,), rows)
     def delete_some(self, start, end, limit=1000):
         tc = self.db.total_changes
         with self.db as conn:
@@ -144,6 +173,47 @@ class IndexTable(SQLTable):
                 DELETE FROM _index
                     WHERE idata >= ? AND idata < ?''', (buffer(start), buffer(end)))
         return self.db.total_changes - tc
+    def upgrade(self, conn):
+        '''
+        Index rows used to refer to documents by their _id, rebuilds the
+        table if it still has those.  Returns whether it was rebuilt.
+        '''
+        for cid, name, type, notnull, default, pk in conn.execute('PRAGMA table_info(%s)'%(self.table_name,)):
+            if name == 'rowref' and type.upper() != 'TEXT':
+                return False
+        old = self.table_name + '_old'
+        conn.execute('ALTER TABLE %s RENAME TO %s'%(self.table_name, old))
+        for name, cols, unique in self.indexes:
+            conn.execute('DROP INDEX IF EXISTS %s'%(name,))
+        self.create()
+        conn.execute('''
+            INSERT OR IGNORE INTO %s (idata, rowref)
+                SELECT idata, _data.rowid
+                    FROM %s
+                    INNER JOIN _data ON _data._id = %s.rowref
+                    ORDER BY %s.rowid'''%(self.table_name, old, old, old))
+        conn.execute('DROP TABLE %s'%(old,))
+        return True
+
+class SingleIndexTable(IndexTable):
+    '''
+    Holds the rows of a single index, without the index id prefix that every
+    one of its keys shares.  The table is only created by create(), so that
+    read-only connections can use it, and is removed all at once by drop().
+    '''
+    def __init__(self, db, index_id, prefix, clustered=False):
+        self.table_name = '_index_%i'%(index_id,)
+        self.indexes = [
+            (self.table_name + '_idata', ('idata',), False),
+            (self.table_name + '_irowref', ('rowref',), False),
+        ]
+        self.prefix = prefix
+        IndexTable.__init__(self, db, clustered)
+    def setup(self):
+        self._cols = [colname.partition(' ')[0] for colname in self.columns]
+    def drop(self, conn=None):
+        conn = conn or self.db
+        conn.execute('DROP TABLE IF EXISTS %s'%(self.table_name,))
 
 @apply
 def CAN_USE_CLOCK():
@@ -200,11 +270,60 @@ class DataTable(IndexTable):
     columns = 'rowid INTEGER PRIMARY KEY', '_id TEXT UNIQUE', 'data JSON', 'last_updated INTEGER UNIQUE'
     table_name = '_data'
     indexes = ()
+    def __init__(self, db, codec=None):
+        # documents are encoded by the table's codec, or as plain JSON
+        self.codec = codec or adapt.Codec()
+        IndexTable.__init__(self, db)
     def insert(self, data, conn=None):
+        _id = data.pop('_id')
         for t in _time_seq():
-            return SQLTable.insert(self, (data.pop('_id'), data, t), conn=conn)
+            return SQLTable.insert(self, (_id, self.codec.encode(data), t), conn=conn)
     def insert_many(self, data, conn=None):
-        return SQLTable.insert_many(self, zip((d.pop('_id') for d in data), data, _time_seq()), conn=conn)
+        # The rowids are assigned here, so that the index rows of the new
+        # documents can refer to them.
+        conn = conn or self.db
+        start = conn.execute('SELECT MAX(rowid) FROM %s'%(self.table_name,)).fetchone()[0] or 0
+        rowids = range(start + 1, start + 1 + len(data))
+        conn.executemany('''
+            INSERT INTO %s (rowid, %s) VALUES (?, ?, ?, ?);
+            '''%(self.table_name, ', '.join(self._cols)),
+            zip(rowids, [d.pop('_id') for d in data], map(self.codec.encode, data), _time_seq()))
+        return rowids
     def update(self, data, uuid, conn=None):
+        data = self.codec.encode(data)
         for t in _time_seq():
             return SQLTable.update(self, [('data', data), ('last_updated', t)], _id=uuid, conn=conn)
+
+class MetadataTable(SQLTable):
+    # settings that the table was last written with, by name
+    columns = 'name TEXT PRIMARY KEY', 'value TEXT'
+    table_name = '_metadata'
+    def get(self, name, conn=None):
+        row = self.select_one(('value',), name=name, conn=conn)
+        return row[0] if row else None
+    def set(self, name, value, conn=None):
+        self.insert((name, value), 'OR REPLACE', conn=conn)
+
+class DictionaryTable(SQLTable):
+    # the compression dictionaries of the table's documents, by their id in
+    # the documents compressed with them
+    columns = 'rowid INTEGER PRIMARY KEY', 'dictionary_id INTEGER UNIQUE', 'dictionary BLOB'
+    table_name = '_dictionaries'
+    def load(self, conn=None):
+        '''
+        Makes the documents compressed with any of the dictionaries readable.
+        '''
+        conn = conn or self.db
+        for dictionary_id, in conn.execute('SELECT dictionary_id FROM _dictionaries').fetchall():
+            if dictionary_id not in adapt.DICTIONARIES:
+                dictionary = self.select_one(('dictionary',), dictionary_id=dictionary_id, conn=conn)[0]
+                adapt.add_dictionary(str(dictionary))
+    def latest(self, conn=None):
+        # the dictionary that new documents are compressed with, or None
+        conn = conn or self.db
+        for dictionary, in conn.execute('SELECT dictionary FROM _dictionaries ORDER BY rowid DESC LIMIT 1'):
+            return str(dictionary)
+    def add(self, dictionary, conn=None):
+        conn = conn or self.db
+        conn.execute('INSERT INTO _dictionaries (dictionary_id, dictionary) VALUES (?, ?)',
+            (adapt.add_dictionary(dictionary), buffer(dictionary)))
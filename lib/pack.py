@@ -141,6 +141,42 @@ def _pack_data(v, case_sensitive=True, neg=False):
             out[i] ^= 0xff
     return out.tostring()
 
+def pack_prefix(v, case_sensitive=True, neg=False):
+    '''
+    Returns the (start, end) range of packed strings that start with the
+    provided string, start inclusive and end exclusive.
+
+    Because _pack_data() emits 7 bit groups, the packed form of a prefix is
+    not a byte prefix of the packed form of the longer string.  All of the
+    complete groups are shared, but only the high bits of the trailing
+    partial group are, so we have to bound that last byte.  As with
+    _pack_data(), trailing nulls can't be told apart from the padding.
+    '''
+    if not isinstance(v, basestring):
+        raise exceptions.PackError("Can only search for prefixes of strings, not %r"%(v,))
+    packed = _pack_data(v, case_sensitive)
+    if not case_sensitive:
+        v = v.lower()
+    if not isinstance(v, unicode):
+        v = v.decode('latin-1')
+    bits = sum(9 if c != '\0' else 1 for c in v.encode('utf-32-be'))
+    full, extra = divmod(bits, 7)
+    base = packed[:full+1]
+    if extra:
+        high = (ord(packed[full+1]) - 1) >> (7 - extra)
+        first = 1 + (high << (7 - extra))
+        last = 1 + ((high + 1) << (7 - extra))
+    else:
+        # any data byte or the terminator may follow
+        first, last = 0, 129
+    if not neg:
+        return base + chr(first), base + chr(last)
+    base = base[:1] + ''.join(chr(ord(c) ^ 0xff) for c in base[1:])
+    start = base + chr((last - 1) ^ 0xff)
+    if first:
+        return start, base + chr((first ^ 0xff) + 1)
+    return start, base[:-1] + chr(ord(base[-1]) + 1)
+
 def _pack_datetime(v, case_sensitive=True, neg=False):
     assert v.tzinfo is None
     # the zero day is jan 1, 1970
@@ -201,9 +237,12 @@ PACK_TABLE = {
 def pack(v, case_sensitive=True, neg=False, _type=type, _table=PACK_TABLE):
     return _table[_type(v)](v, case_sensitive=case_sensitive, neg=neg)
 
-def generate_index_rows(data, index_dict, config, _pack=pack):
+def generate_index_rows(data, index_dict, config, _pack=pack, multi=None, swapped=()):
     # We need to generate the index rows for the given set of indexes and the
-    # data provided.
+    # data provided.  If multi is a set, the ids of those indexes that produce
+    # more than one row for this data will be added to it.  The indexes with
+    # ids in swapped pack 'col-' columns case sensitively and the others case
+    # insensitively, like indexes used to.
     max_row_count = config.MAX_INDEX_ROW_COUNT
     max_row_len = config.MAX_INDEX_ROW_LENGTH
     row_over_count = config.TOO_MANY_ROWS
@@ -217,23 +256,25 @@ def generate_index_rows(data, index_dict, config, _pack=pack):
 
     for cols, iid in index_dict.iteritems():
         index_cols = [(pack(iid)[1:],)]
+        swap = iid in swapped
         for col in cols.rstrip(',').split(','):
             cname = col.strip('-')
-            if col not in cache:
-                cache[col] = _pack(data.get(cname), case_sensitive=col.endswith('-'), neg=col.startswith('-'))
-                cc = cache[col]
+            key = col, swap
+            if key not in cache:
+                cache[key] = _pack(data.get(cname), case_sensitive=col.endswith('-') == swap, neg=col.startswith('-'))
+                cc = cache[key]
                 # We convert everything into a sequence, so we can let
                 # itertools.product() do the cartesian product of all of them,
                 # which is necessary for proper list indexing.
                 if cc is None:
-                    cache[col] = ()
+                    cache[key] = ()
                 elif not isinstance(cc, _seqs):
-                    cache[col] = (cc,)
+                    cache[key] = (cc,)
                 else:
-                    cache[col] = [i for i in cc if i]
-            if not cache[col]:
+                    cache[key] = [i for i in cc if i]
+            if not cache[key]:
                 break
-            index_cols.append(cache[col])
+            index_cols.append(cache[key])
         else:
             # save the references for actual creation later
             usable_indexes.append(index_cols)
@@ -241,6 +282,8 @@ def generate_index_rows(data, index_dict, config, _pack=pack):
             for col_data in index_cols:
                 cnt *= len(col_data)
             index_row_count += cnt
+            if cnt > 1 and multi is not None:
+                multi.add(iid)
 
     if index_row_count > max_row_count and row_over_count == 'fail':
         raise exceptions.TooManyIndexRows("Index row count %i exceeds maximum count %i"%(index_row_count, max_row_count))
@@ -1,58 +1,224 @@
 
 from collections import deque
 from functools import wraps
-import os
+import inspect
 from Queue import Empty
 import time
 import traceback
 
+from .lib.cache import LRUCache
+from .lib import backends
 from .lib import exceptions
-from .lib import pack
-from .lib import table as adapt_table
+
+# operations that don't change the contents or indexes of a table, and that
+# read-only processors can perform
+READ_OPERATIONS = frozenset(['count', 'exists', 'get', 'info', 'ping', 'search'])
+# read operations that only the processor performing writes can answer, as
+# it is the one building indexes, taking backups and the like
+WRITER_READ_OPERATIONS = frozenset(['info'])
+# read operations whose results are cached (when enabled)
+CACHED_OPERATIONS = frozenset(['count', 'exists', 'search'])
+# operations that can share a transaction with their neighbors
+GROUPED_OPERATIONS = frozenset(['delete', 'insert', 'update'])
 
 def handle_exception(processor):
     @wraps(processor)
-    def run(config, table, queue, results):
+    def run(config, table, queue, results, readonly=False):
         try:
-            return processor(config, table, queue, results)
+            return processor(config, table, queue, results, readonly)
         except (KeyboardInterrupt, SystemExit):
             raise
         except Exception:
             out = traceback.format_exc().rstrip()
             results.put((None, None, {'exception':'UnknownExceptionError', 'table_name':table, 'args':(out,)}))
-            results.put((None, None, {'response':'quit', 'table_name':table}))
+            results.put((None, None, {'response':'quit', 'table_name':table, 'readonly':readonly}))
             raise
     return run
 
+# Requests are handed out earliest deadline first, where the deadline of a
+# request is when it was received plus the latency target of its lane.
+LANES = ('read', 'write', 'admin')
+
+def _lane(item):
+    # Chooses the lane for a request, clients can pick one with the
+    # _priority keyword argument.  Control messages get their own lane.
+    sid, oid, operation, args, kwargs = item
+    if sid is None or operation == '_quit':
+        return None
+    lane = kwargs.pop('_priority', None) if isinstance(kwargs, dict) else None
+    if lane in LANES:
+        return lane
+    if isinstance(operation, str):
+        if operation in READ_OPERATIONS:
+            return 'read'
+        if operation in GROUPED_OPERATIONS:
+            return 'write'
+    return 'admin'
+
 class QueueWrapper(object):
-    def __init__(self, q):
+    '''
+    Takes requests from a table's queue into separate lanes for reads,
+    writes and admin operations, so that quick reads don't have to wait
+    behind slow writes.  Control messages wait for the lanes to be emptied.
+
+    At most limit requests are taken into the lanes (0 is no limit), so that
+    the table's queue fills up when the processor can't keep up.  Requests
+    with a _deadline that has passed when they would be handed out are passed
+    to expired() instead.
+    '''
+    def __init__(self, q, targets=None, limit=0, expired=None):
         self.q = q
-        self.v = deque()
-    def get(self, *args, **kwargs):
-        if self.v:
-            return self.v.popleft()
-        return self.q.get(*args, **kwargs)
-    def push(self, v):
-        self.v.append(v)
+        self.targets = targets or {}
+        self.limit = limit
+        self.expired = expired
+        self.lanes = dict((lane, deque()) for lane in LANES + (None,))
+        self.last = None
+    def _add(self, v, lane=None):
+        if lane is None:
+            lane = _lane(v)
+        expires = v[4].pop('_deadline', None) if isinstance(v[4], dict) else None
+        deadline = time.time() + self.targets.get(lane, 0)
+        if expires:
+            deadline = min(deadline, expires)
+        self.lanes[lane].append((deadline, expires, v))
+    def _take(self):
+        # moves what has already been received into the lanes
+        while not self.limit or self._pending() < self.limit:
+            try:
+                self._add(self.q.get(False))
+            except Empty:
+                break
+    def _pending(self):
+        return sum(len(lane) for lane in self.lanes.itervalues())
+    def wait(self, timeout=None):
+        # waits for a request, raising Empty on timeout
+        if not self._pending():
+            self._add(self.q.get(True, timeout))
+    def get(self, block=True, timeout=None):
+        while 1:
+            self._take()
+            if not self._pending():
+                self._add(self.q.get(block, timeout))
+            heads = [(lane[0][0], name) for name, lane in self.lanes.iteritems() if lane and name]
+            name = min(heads)[1] if heads else None
+            deadline, expires, v = self.lanes[name].popleft()
+            if expires and expires < time.time() and self.expired:
+                self.expired(v)
+                continue
+            self.last = name, deadline, expires
+            return v
+    def push(self, v, lane=None):
+        self._add(v, lane)
+    def unget(self, v):
+        # returns the last item from get() to the front of its lane
+        name, deadline, expires = self.last
+        self.lanes[name].appendleft((deadline, expires, v))
     def qsize(self):
-        return len(self.v) + self.q.qsize()
+        return self._pending() + self.q.qsize()
+
+def _freeze(value):
+    # Turns query arguments into something hashable.  Lists and tuples are
+    # equivalent (JSON clients only send lists), but values of different
+    # types can index differently, so their types are kept.
+    if isinstance(value, (list, tuple)):
+        return tuple(map(_freeze, value))
+    elif isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(map(_freeze, value))
+    elif isinstance(value, basestring):
+        return value
+    return value.__class__, value
+
+def _query_key(method, operation, args, kwargs):
+    # normalizes positional, keyword and default arguments into a cache key
+    try:
+        call = inspect.getcallargs(method, *args, **kwargs)
+        call.pop('self', None)
+        key = operation, _freeze(call)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _is_large(q, slice_size):
+    # whether a request is a list mutation to be performed in slices
+    operation, args = q[2:4]
+    return bool(slice_size and args) and isinstance(operation, str) and \
+        operation in GROUPED_OPERATIONS and isinstance(args[0], list) and len(args[0]) > slice_size
+
+def _drain_mutations(queue, first, group, size, deadline, slice_size=0):
+    # Yields the first request and the groupable requests directly behind it
+    # that are already queued, until either the size or time runs out.  The
+    # requests are also appended to the group list.
+    q = first
+    while 1:
+        group.append(q)
+        yield q[2:]
+        if len(group) >= size or time.time() >= deadline:
+            break
+        try:
+            q = queue.get(False)
+        except Empty:
+            break
+        if q[0] is None or not (isinstance(q[2], str) and q[2] in GROUPED_OPERATIONS) \
+                or _is_large(q, slice_size):
+            queue.unget(q)
+            break
 
 def _new_count(old_count, delta, desired, minimum, maximum):
     return int(min(maximum, max(minimum, old_count * desired / (delta or .001))))
 
 @handle_exception
-def queue_processor(config, table, queue, results):
-    queue = QueueWrapper(queue)
+def queue_processor(config, table, queue, results, readonly=False):
+    '''
+    Handles the requests for a table.  A readonly processor only performs
+    read operations, and leaves indexing and other maintenance to the table's
+    one writable processor.
+    '''
+    def expired(q):
+        results.put((q[0], q[1], {'exception':'Overloaded', 'table_name':table,
+            'args':("Request for table %r expired before it could be handled", table)}))
+    queue = QueueWrapper(queue, config.LANE_LATENCY, config.MAX_QUEUE_SIZE, expired)
     # open or create the table
-    table_adapter = adapt_table.TableAdapter(os.path.join(config.PATH, table + '.sqlite'), table, config)
-    # respond with the list of known indexes
-    results.put((None, None, {'response':'indexes', 'table_name':table, 'value':table_adapter.known_indexes}))
+    table_adapter = backends.open_table(config, table, readonly)
+    if not readonly:
+        # respond with the list of known indexes
+        results.put((None, None, {'response':'indexes', 'table_name':table, 'value':table_adapter.known_indexes}))
     idle_sleep = max(.001, min(.1, config.DESIRED_LATENCY))
+    # Cached query results are tagged with the generation they were computed
+    # in, and every change to the table starts a new generation.
+    query_cache = None
+    if config.QUERY_CACHE_ENTRIES:
+        query_cache = LRUCache(config.QUERY_CACHE_ENTRIES)
+    generation = 0
+    # The state of list mutations being performed in slices, by (sid, oid).
+    slice_size = config.MUTATION_SLICE_SIZE
+    sliced = {}
+    def respond(sid, oid, response):
+        # responses to slices are combined into one response
+        state = sliced.get((sid, oid))
+        if state is not None:
+            if 'exception' not in response:
+                state['done'].extend(response['value'])
+                if state['rest']:
+                    return
+                response['value'] = state['done']
+            del sliced[sid, oid]
+        results.put((sid, oid, response))
+    # the time spent on maintenance during the current period, while busy
+    maintenance_time = 0 if readonly else config.MAINTENANCE_TIME
+    period_start = time.time()
+    maintenance_used = 0
+    # whether there may be write-ahead log pages to checkpoint
+    needs_checkpoint = False
     keep_running = True
-    check_for_idle_work = True
+    check_for_idle_work = not readonly
     index_count = 1
+    bulk_count = 100
     delete_count = 1
     vacuum_count = 1
+    snapshot_count = 100
     while keep_running:
         qsize = queue.qsize()
 
@@ -73,25 +239,46 @@ def queue_processor(config, table, queue, results):
         # transition to state 3, where it will remain until there is work to
         # do.
 
-        if check_for_idle_work and not qsize:
+        # Index builds and deletes, backups and snapshots get at least
+        # MAINTENANCE_TIME seconds out of every MAINTENANCE_PERIOD, even when
+        # the requests never stop coming.
+        forced = False
+        if qsize and maintenance_time and (table_adapter._bulk is not None or
+                table_adapter.indexes_in_progress or table_adapter.indexes_being_removed or
+                table_adapter._snapshot_due()):
+            now = time.time()
+            if now - period_start >= config.MAINTENANCE_PERIOD:
+                period_start = now
+                maintenance_used = 0
+            forced = maintenance_used < maintenance_time
+
+        if forced or (check_for_idle_work and not qsize):
             in_progress = table_adapter.indexes_in_progress
             being_deleted = table_adapter.indexes_being_removed
+            now = time.time()
+
+            # Bulk index builds scan and insert many more rows per step than
+            # incremental builds, so they get their own batch size.
+            if table_adapter._bulk is not None:
+                steps, changed = table_adapter._bulk_some(bulk_count)
+                needs_checkpoint = True
+                if changed:
+                    generation += 1
+                if steps:
+                    bulk_count = _new_count(bulk_count, time.time() - now, idle_sleep, 100, 100000)
 
             # If we don't have any pending operations, and we haven't performed
             # any operations for a little while...do some indexing.
-            if in_progress:
-                now = time.time()
-                with table_adapter.db as cursor:
-                    li, rows = table_adapter._next_index_row(index_count, cursor)
-                    if not rows:
-                        # just finished catching up with indexes
-                        continue
-                    last_updated = li
-                    for row in rows:
-                        rowid, _id, data, last_updated = row
-                        data['_id'] = _id
-                        table_adapter.update(data, cursor, index_only=True)
-                    table_adapter.indexes.update([('last_indexed', last_updated)], last_indexed=li, conn=cursor)
+            elif in_progress:
+                indexed, changed = table_adapter._index_some(index_count)
+                if not indexed:
+                    # just finished catching up with indexes
+                    continue
+                needs_checkpoint = True
+                if changed:
+                    # rows written since the index was added were already
+                    # indexed, and don't change any results
+                    generation += 1
                 # Ultimately, we want to increase the number of rows we index at a
                 # time in order to increase indexing performance.  However, that
                 # also increases the latency for subsequent queries, so we need to
@@ -101,58 +288,134 @@ def queue_processor(config, table, queue, results):
             # If we don't have any pending operations, and we haven't performed
             # any operations for a little while...delete some indexes.
             elif being_deleted:
-                now = time.time()
-                to_delete = being_deleted[0]
-                start = pack.pack(to_delete)[1:]
-                end = pack.pack(to_delete+1)[1:]
-                deleted = table_adapter.index.delete_some(start, end, delete_count)
-                if not deleted:
-                    being_deleted.pop(0)
-                    table_adapter.indexes.delete(index_id=to_delete)
-                    table_adapter._refresh_indexes()
+                generation += 1
+                needs_checkpoint = True
+                deleted, finished = table_adapter._delete_some(delete_count)
+                if finished:
                     results.put((None, None, {'response':'indexes', 'table_name':table, 'value':table_adapter.known_indexes}))
-                    deleted += 1
                 # A similar argument applies to row deletion as we made for row
                 # indexing.  We'll increase the number of index rows that we'll
                 # delete as long as it stays under our desired latency.
                 delete_count = _new_count(delete_count, time.time() - now, idle_sleep, 1, 5000)
 
+            # Checkpoint the write-ahead log while we aren't busy, so that the
+            # checkpoints done during commits have less to do.
+            elif needs_checkpoint and table_adapter.wal:
+                table_adapter._checkpoint()
+                needs_checkpoint = False
+
+            # Write some more of a backup, or of the snapshot of an in-memory
+            # table.
+            elif table_adapter._snapshot_due():
+                written = table_adapter._snapshot_some(snapshot_count)
+                if written:
+                    snapshot_count = _new_count(snapshot_count, time.time() - now, idle_sleep, 100, 100000)
+
             elif config.AUTOVACUUM == 2:
                 now = time.time()
-                fc = table_adapter._pragma_read('freelist_count')
-                if fc >= config.MINIMUM_VACUUM_BLOCKS:
-                    table_adapter.db.execute('PRAGMA incremental_vacuum(%i)'%(vacuum_count,))
-                    fc -= table_adapter._pragma_read('freelist_count')
+                fc = table_adapter._vacuum_some(vacuum_count)
+                if fc is not None:
+                    needs_checkpoint = True
                     vacuum_count = _new_count(max(fc, 1), time.time() - now, idle_sleep, 1, 5000)
                 else:
                     check_for_idle_work = False
             else:
                 check_for_idle_work = False
 
+            if forced:
+                maintenance_used += time.time() - now
             continue
 
         elif not qsize:
             try:
-                queue.push(queue.get(timeout=config.IDLE_TIMEOUT))
+                queue.wait(config.IDLE_TIMEOUT)
             except Empty:
+                # snapshots come due without any requests
+                check_for_idle_work = table_adapter._snapshot_due()
                 continue
 
-        check_for_idle_work = True
+        check_for_idle_work = not readonly
 
-        q = queue.get()
+        try:
+            q = queue.get(False)
+        except Empty:
+            # everything that was waiting had expired
+            continue
         sid, oid, operation, args, kwargs = q
         if sid is None:
+            # shutting down, write out whatever hasn't been snapshotted yet
+            table_adapter._flush()
+            results.put((None, None, {'response':'quit', 'table_name':table, 'readonly':readonly}))
             break
 
+        if operation == '_continue' or _is_large(q, slice_size):
+            # Perform a large list mutation one slice at a time, with any
+            # reads that arrive in the meantime getting their turn.
+            if operation == '_continue':
+                state = sliced.get((sid, oid))
+                if state is None:
+                    # an earlier slice failed
+                    continue
+                items = state['rest']
+            else:
+                state = sliced[sid, oid] = {'done':[], 'operation':operation, 'args':args[1:], 'kwargs':kwargs}
+                items = args[0]
+            state['rest'] = items[slice_size:]
+            operation = state['operation']
+            q = sid, oid, operation, (items[:slice_size],) + state['args'], state['kwargs']
+            sid, oid, operation, args, kwargs = q
+            if state['rest']:
+                queue.push((sid, oid, '_continue', (), {}), 'write')
+
         old = None
+        # the writer may have changed the table since our last request
+        if readonly and table_adapter._changed():
+            generation += 1
+
+        if not readonly and isinstance(operation, str) and operation in GROUPED_OPERATIONS \
+                and config.GROUP_COMMIT_SIZE > 1:
+            # Commit the consecutive writes that are waiting together, but
+            # respond to each of them individually.
+            generation += 1
+            needs_checkpoint = True
+            group = []
+            done = table_adapter._group_commit(_drain_mutations(queue, q, group,
+                config.GROUP_COMMIT_SIZE, time.time() + config.GROUP_COMMIT_TIME, slice_size))
+            for (sid, oid, operation, args, kwargs), (value, e) in zip(group, done):
+                if e is None:
+                    response = {'response':'ok', 'value':value}
+                else:
+                    response = {'exception':e.__class__.__name__, 'table_name':table, 'args':e.args}
+                respond(sid, oid, response)
+            continue
         try:
             # perform the operation
-            if isinstance(operation, str) and operation[:1] != '_' and hasattr(table_adapter, operation):
+            if readonly and operation != '_quit' and not (isinstance(operation, str) and operation in READ_OPERATIONS):
+                raise exceptions.InvalidOperation(operation)
+            elif isinstance(operation, str) and operation[:1] != '_' and hasattr(table_adapter, operation):
                 if '_index' in operation:
                     old = set(table_adapter.known_indexes)
-                response = {'response':'ok', 'value':getattr(table_adapter, operation)(*args, **kwargs)}
+                method = getattr(table_adapter, operation)
+                if operation not in READ_OPERATIONS:
+                    generation += 1
+                    needs_checkpoint = True
+                key = cached = None
+                if query_cache is not None and operation in CACHED_OPERATIONS:
+                    key = _query_key(method, operation, args, kwargs)
+                    if key is not None:
+                        cached = query_cache.get(key, valid=lambda c: c[0] == generation)
+                if cached:
+                    value = cached[1]
+                else:
+                    value = method(*args, **kwargs)
+                    if key is not None:
+                        query_cache.put(key, (generation, value))
+                if operation == 'info':
+                    value['query_cache'] = query_cache.stats() if query_cache is not None else None
+                response = {'response':'ok', 'value':value}
             elif operation == '_quit':
-                results.put((None, None, {'response':'quit', 'table_name':table}))
+                table_adapter._flush()
+                results.put((None, None, {'response':'quit', 'table_name':table, 'readonly':readonly}))
                 break
             else:
                 raise exceptions.InvalidOperation(operation)
@@ -169,4 +432,8 @@ def queue_processor(config, table, queue, results):
                 keep_running = False
                 results.put((None, None, {'response':'indexes', 'table_name':table, 'value':[]}))
                 results.put((None, None, {'response':'quit', 'table_name':table}))
-        results.put((sid, oid, response))
+        respond(sid, oid, response)
+
+    # a processor that dies instead has its key workers stopped as it exits,
+    # or they notice that it's gone
+    table_adapter._close()
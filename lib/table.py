@@ -3,6 +3,7 @@ from __future__ import with_statement
 
 import bisect
 from contextlib import contextmanager
+import heapq
 import itertools
 import os
 import re
@@ -11,17 +12,25 @@ import sys
 import time
 import uuid
 
+from .lib.adapt import Codec, FORMATS, train_dictionary
+from .lib.backup import Backup, Compaction
+from .lib.bulk import BulkIndexBuild
+from .lib.cache import LRUCache
 from .lib.exceptions import BAD_NAMES, ColumnException, IndexWarning, \
-    MalformedFilterError, TableIndexError, UpdateError
+    InvalidOperation, MalformedFilterError, TableIndexError, UpdateError
+from .lib.keygen import KeyPool
 from .thirdparty.lispy import run_script
-from .lib.om import DataTable, IndexInfo, IndexTable
-from .lib.pack import generate_index_rows, pack, Some
+from .lib.om import DataTable, DictionaryTable, IndexInfo, IndexTable, MetadataTable, \
+    SingleIndexTable
+from .lib.pack import generate_index_rows, pack, pack_prefix, Some
 
 errors = (IOError, OSError)
 if sys.platform.startswith('win'):
     errors = (IOError, OSError, WindowsError)
 
 PAGE_SIZES = (512, 1024, 2048, 4096, 8192, 16384, 32768)
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
 COL_REGEX = re.compile('^[-+]?[a-z_][a-z0-9_]*[-+]?$')
 
 def _resolve(col, dct, op):
@@ -61,6 +70,93 @@ def filter_prefixes(filters, orders):
 def _flip_orders(orders):
     return ['-' + order if order[:1] != '-' else order.strip('-') for order in orders]
 
+def _parse_limit(limit, count=False):
+    # adjust the limit clause
+    if limit is not None:
+        if isinstance(limit, (list, tuple)):
+            if len(limit) != 2:
+                raise MalformedFilterError("bad limit clause")
+            offset, limit = map(int, limit)
+            limit = min(max(limit, 1), 1000)
+            limit = offset, limit
+        else:
+            limit = min(max(int(limit), 1), 1000)
+    elif not count:
+        limit = 1000
+    return limit
+
+def _order_key(order):
+    # Packs the ordered columns the same way that an index would, so that
+    # in-memory sorts match the order of index scans.  Rows that could not
+    # appear in such an index (empty lists, unpackable values) get a key of
+    # None.
+    cols = [(col.strip('-'), not col.endswith('-'), col.startswith('-'))
+        for col in order]
+    def key(data):
+        out = []
+        for name, cased, neg in cols:
+            try:
+                value = pack(data.get(name), case_sensitive=cased, neg=neg)
+            except KeyError:
+                return None
+            if isinstance(value, list):
+                # A row with a list value appears in an index once per item,
+                # an ordered index scan will see the smallest one first.
+                value = [v for v in value if v]
+                if not value:
+                    return None
+                value = min(value)
+            out.append(value)
+        return out
+    return key
+
+class _Prefix(object):
+    # marks the value of a 'startswith' filter
+    def __init__(self, value):
+        self.value = value
+
+MAX_DISJUNCTIONS = 100
+
+def _disjunction(filters):
+    # Rewrites filters into a list of filter lists whose results should be
+    # merged.  IN becomes one filter list per value, and != becomes a pair of
+    # filter lists with ranges on either side of the value.
+    if filters and isinstance(filters[0], (list, tuple)) and \
+            (not filters[0] or not isinstance(filters[0][0], basestring)):
+        conjunctions = filters
+    else:
+        conjunctions = [filters]
+    out = []
+    for conjunction in conjunctions:
+        branches = [[]]
+        for col, comparison, value in conjunction:
+            if comparison == 'IN':
+                alternatives = [(col, '=', v) for v in value]
+            elif comparison == '!=':
+                alternatives = [(col, '<', value), (col, '>', value)]
+            else:
+                alternatives = [(col, comparison, value)]
+            branches = [branch + [alt] for branch in branches for alt in alternatives]
+        out.extend(branches)
+        if len(out) > MAX_DISJUNCTIONS:
+            raise MalformedFilterError("filters expand to more than %i searches", MAX_DISJUNCTIONS)
+    return out
+
+def _tighter(value, comparison, old, old_comparison, case_sensitive):
+    # whether the bound `comparison value` is tighter than `old_comparison old`
+    new = pack(value, case_sensitive=case_sensitive)
+    old = pack(old, case_sensitive=case_sensitive)
+    if new == old:
+        return len(comparison) < len(old_comparison)
+    return (new < old) == (comparison[0] == '<')
+
+def _limit_clause(limit):
+    if not limit:
+        return ''
+    if isinstance(limit, tuple):
+        return ' LIMIT %i,%i'%limit
+    return ' LIMIT %i'%(limit,)
+
 def _select_clause(table_name):
     return "SELECT *, rowid FROM %s "%(table_name,)
 
@@ -79,24 +175,318 @@ def _cursor(cursor):
     else:
         yield cursor
 
-def _index_rows(data, indexes_to_ids, config):
-    # get the rows to index first
-    row_count, index_rows = generate_index_rows(data, indexes_to_ids, config)
+def _apply_update(existing_data, data, shared):
+    # Applies the assignments and __ops script of an update to the existing
+    # document, returning it.
+    ops = data.pop('__ops', '')
+    operations = itertools.chain(data.iteritems(), [('__ops', ops)])
+    for col, value in operations:
+        existing = existing_data
+
+        if col != '__ops':
+            # handle simple assignment
+            col, existing = _resolve(col, existing, '=')
+            existing[col] = value
+            continue
+
+        # no operation, skip it
+        if not value:
+            continue
+
+        # actually perform an operation on the data
+        run_script(value, existing, shared)
+
+    existing_data.pop('_id', None)
+    return existing_data
+
+def _index_rows(data, indexes_to_ids, config, multi=None, generated=None, swapped=()):
+    # get the rows to index first, unless they were generated already
+    if generated is None:
+        generated = generate_index_rows(data, indexes_to_ids, config, multi=multi, swapped=swapped)
+    row_count, index_rows = generated
     if '_id' not in data:
         data['_id'] = new_uuid()
-    rowref = data['_id']
-    index_data = zip(index_rows, itertools.repeat(rowref))
-    return rowref, row_count, index_data
+    return data['_id'], row_count, index_rows
+
+class BaseTableAdapter(object):
+    '''
+    What a table's processor needs from the storage of a table, along with
+    the query planning that doesn't depend on it.  Backends (see backends.py)
+    provide insert(), update(), delete(), get(), search() (by way of
+    _search_rows()), count(), exists(), add_index(), drop_index(), info() and
+    drop_table(), plus _group_commit() for the processor.  Backends that
+    don't index or clean up in the background can leave the maintenance
+    hooks below alone.
+    '''
+    wal = False
+    _bulk = None
+    indexes_in_progress = ()
+    indexes_being_removed = ()
+    case_swapped = frozenset()
+
+    def _changed(self):
+        return False
+
+    def _checkpoint(self):
+        return None
+
+    def _vacuum_some(self, count):
+        return None
+
+    def _snapshot_due(self, force=False):
+        return False
+
+    def _snapshot_some(self, count):
+        return 0
+
+    def _flush(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def ping(self):
+        return "pong"
+
+    def get_drop_key(self):
+        '''
+        Generates a new key to drop the table.
+        '''
+        self.drop_key = new_uuid()
+        return self.drop_key
+
+    def _col_def(self, columns):
+        # check for a valid index
+        if not columns:
+            raise IndexWarning("Cannot create null index")
+        # check for valid column names
+        columns = list(columns)
+        for i, column in enumerate(columns):
+            if not COL_REGEX.match(column) or column in BAD_NAMES:
+                raise ColumnException("Bad column name: %r", column)
+            columns[i] = column.strip('+')
+
+        if len(columns) != len(set(col.strip('-') for col in columns)):
+            raise IndexError("Cannot list the same column twice in an index")
+
+        return ','.join(columns) + ','
+
+    def _new_index_def(self, columns):
+        # the definition of a new index, which can't be a prefix of another
+        index_def = self._col_def(columns)
+        # check for duplicate indexes
+        index_check = bisect.bisect_left(self.known_indexes, index_def)
+        if index_check < len(self.known_indexes):
+            if self.known_indexes[index_check].startswith(index_def):
+                raise IndexWarning("New index %r is a prefix of existing index %r",
+                    index_def, self.known_indexes[index_check])
+        return index_def
+
+    def search(self, filters, order=(), limit=None):
+        '''
+        Search the table with the provided filters, order, and limit.
+
+        Filters are of the form:
+            [('name', 'comparison', value), ...]
+        With 'comparison' being one of: '=', '!=', '<', '<=', '>', '>=', 'IN',
+        or 'startswith' .
+
+        Like the other range comparisons, startswith (which takes a string)
+        must be on the last filtered column, and it follows the case
+        sensitivity and order of the index.
+
+        Filters may also be a list of filter lists:
+            [[('name', 'comparison', value), ...], ...]
+        In which case rows matching any of the filter lists are returned.
+        Internally, IN is searched as one filter list per value, and != as a
+        pair of filter lists with < and >.  Each filter list is searched with
+        its own index range scan, and the results are merged by _id.
+
+        Orders are optional order clauses, which are specified as a sequence:
+            ['colname', '-colname', ...]
+        Where 'colname' is the standard sort order of the column, and
+        '-colname' is the reverse sort order of the column.  These order
+        clauses can help to choose a specific index if more than one index
+        could satisfy the query.  If no index can provide the requested order,
+        but an index can satisfy the filters, the matching rows are streamed
+        from that index and sorted in memory, keeping at most offset+limit
+        rows at a time.  When multiple filter lists are searched, the merged
+        results are sorted by the order columns.
+
+        Limit is either a numeric limited number of rows to return (defaulting
+        and limited to at most 1000, or when provided as a tuple, is the
+        (offset,limit) .
+        '''
+        limit = _parse_limit(limit)
+        branches = _disjunction(filters)
+        if len(branches) == 1:
+            return self._search_rows(branches[0], order, limit)
+        return self._search_union(branches, order, limit)
+
+    def _search_union(self, branches, order, limit):
+        '''
+        Searches each of the filter lists for their first offset+limit rows,
+        merging them by _id.
+        '''
+        offset, limit = limit if isinstance(limit, tuple) else (0, limit)
+        seen = set()
+        out = []
+        for branch in branches:
+            for data in self._search_rows(branch, order, offset + limit, sort=True):
+                if data['_id'] not in seen:
+                    seen.add(data['_id'])
+                    out.append(data)
+        if order:
+            key = _order_key(order)
+            out = heapq.nsmallest(offset + limit,
+                (data for data in out if key(data) is not None), key=key)
+        return out[offset:offset + limit]
+
+    def _key_range(self, filters, order):
+        '''
+        Chooses an index for the filters and order, returning the index id,
+        whether the index should be scanned in reverse, and the range of its
+        keys (without the index id) to scan: keys >= lower, and either
+        < or <= upper (the comparison is returned), or all of the rest when
+        upper is None.
+        '''
+        # find an index/order
+        usable_indexes = []
+        for prefix_regexp in filter_prefixes(filters, order):
+            usable_indexes.append([index for index in self.known_indexes if prefix_regexp.match(index)])
+        try:
+            use_index = sorted(sum(usable_indexes, []), key=lambda i:i.count(','))[0]
+        except IndexError:
+            raise TableIndexError("no known indexes match specified query")
+        reverse = use_index not in usable_indexes[0]
+        index_cols = use_index.rstrip(',').split(',')
+        # see generate_index_rows()
+        swapped = self.indexes_to_ids[use_index] in self.case_swapped
+        # If there exists a minimal index to do what we want (in terms of
+        # fewest columns), we will have found it.
+
+        cols = filter_prefix(filters).count(',')
+        prefix = cols * [None]
+        ok_mini = ['>=', '>']
+        ok_maxi = ['<=', '<']
+        neq_query = False
+        # mini and maxi will have a shared prefix of data, with an optional
+        # minimum and maximum value with comparisons.
+        index = -1
+
+        # generate the prefix for our queries
+        lc = None
+        for col, comparison, value in filters:
+            if lc != col:
+                index += 1
+            lc = col
+            if comparison == '=':
+                if prefix[index] is not None:
+                    raise MalformedFilterError("bad filters")
+                if neq_query:
+                    raise MalformedFilterError("bad filters")
+                prefix[index] = value
+            elif comparison in ('<=', '<', '>=', '>'):
+                if not isinstance(prefix[index], (list, type(None))) or \
+                        (neq_query and prefix[index] is None):
+                    raise MalformedFilterError("bad filters")
+                neq_query = True
+                if prefix[index] is None:
+                    prefix[index] = [None, Some]
+                # When there is more than one bound on the same side (like
+                # after rewriting !=), keep the tightest.
+                cased = index_cols[index].endswith('-') == swapped
+                if comparison[0] == '<':
+                    if prefix[index][1] is Some or _tighter(value, comparison,
+                            prefix[index][1], ok_maxi[0], cased):
+                        prefix[index][1] = value
+                        ok_maxi = ['<=', '<'][len(comparison) == 1:]
+                else:
+                    if prefix[index][0] is None or _tighter(value, comparison,
+                            prefix[index][0], ok_mini[0], cased):
+                        prefix[index][0] = value
+                        ok_mini = ['>=', '>'][len(comparison) == 1:]
+            elif comparison == 'startswith':
+                if neq_query or prefix[index] is not None:
+                    raise MalformedFilterError("bad filters")
+                if not isinstance(value, basestring):
+                    raise MalformedFilterError("startswith requires a string")
+                neq_query = True
+                prefix[index] = _Prefix(value)
+            else:
+                raise MalformedFilterError("unknown comparison %r", comparison)
+
+        assert None not in prefix
 
-class TableAdapter(object):
+        # create the data prefix for our query
+        for col_i, (column, value) in enumerate(zip(index_cols, prefix)):
+            is_range = isinstance(prefix[col_i], list)
+            col_neg = column.startswith('-')
+            cased = column.endswith('-') == swapped
+            if isinstance(value, _Prefix):
+                # the packed range is already in index order
+                prefix[col_i] = list(pack_prefix(value.value, case_sensitive=cased, neg=col_neg))
+                ok_mini = ['>=']
+                ok_maxi = ['<']
+                continue
+            prefix[col_i] = pack(value, case_sensitive=cased, neg=col_neg)
+            if is_range and col_neg:
+                lmi = len(ok_mini)
+                lma = len(ok_maxi)
+                ok_mini = ['>=', '>'][-lma:]
+                ok_maxi = ['<=', '<'][-lmi:]
+                prefix[col_i].reverse()
+
+        index_id = self.indexes_to_ids[use_index]
+        suffix = [None, None]
+        if prefix and not isinstance(prefix[-1], str):
+            suffix = prefix.pop()
+        like = ''.join(prefix)
+        # We would use LIKE here (for prefix equalities), but LIKE may not
+        # use indexes, at least for 2.8.6, no idea for the 3 series:
+        # http://web.utk.edu/~jplyon/sqlite/SQLite_optimization_FAQ.html
+        # We're going to convert LIKE into a pair of comparisons, which
+        # should keep things fast, regardless.
+
+        # Do the > or >= part...
+        lower = like
+        if suffix[0] != None:
+            lower += suffix[0]
+        if ok_mini[0] == '>':
+            lower = _add_one(lower)
+
+        # Do the < or <= part...
+        if suffix[1] == None:
+            if not like.strip('\xff'):
+                # every key after lower
+                return index_id, reverse, lower, None, None
+            ok_maxi.pop(0)
+            upper = _add_one(like)
+        else:
+            upper = like + suffix[1]
+
+        return index_id, reverse, lower, upper, ok_maxi[0]
+
+class TableAdapter(BaseTableAdapter):
     class INDEX_FLAGS:
         deleting = 0x1
-    def __init__(self, dbfile, tablename, config):
-        # todo: should probably replace the sqlite3 connect with a passed
-        # backend parameter
+        # set once an index has produced more than one row for a document
+        multiple = 0x2
+        # set while an index is being built by a BulkIndexBuild
+        bulk = 0x4
+        # the index's rows are in their own table, rather than in _index
+        table = 0x8
+        # the index is from before 'col-' columns were case insensitive and
+        # the others case sensitive, and keeps doing the opposite
+        case_swapped = 0x10
+    def __init__(self, dbfile, tablename, config, readonly=False):
         self.config = config
+        self.readonly = readonly
         assert config.BLOCK_SIZE in PAGE_SIZES
         assert config.AUTOVACUUM in (0, 1, 2)
+        assert config.JOURNAL_MODE in JOURNAL_MODES
+        assert config.SYNCHRONOUS in SYNCHRONOUS_MODES
+        assert config.DOCUMENT_FORMAT in FORMATS
         self.dbfile = dbfile
         self.db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
         self.db.execute('PRAGMA page_size = %i'%(config.BLOCK_SIZE,))
@@ -105,12 +495,51 @@ class TableAdapter(object):
         config_autovac = config.AUTOVACUUM == 0
         autovac = self._pragma_read('auto_vacuum') == 0
         self.db.execute('PRAGMA auto_vacuum = %i'%(config.AUTOVACUUM,))
-        if autovac ^ config_autovac:
-            # need to vacuum to get the system working properly :'(
-            self.db.execute('VACUUM')
+        if not readonly:
+            # the writer sets up an existing database file for everyone
+            if autovac ^ config_autovac:
+                # need to vacuum to get the system working properly :'(
+                self.db.execute('VACUUM')
+            self.db.execute('PRAGMA journal_mode = %s'%(config.JOURNAL_MODE,))
+        self.db.execute('PRAGMA synchronous = %s'%(config.SYNCHRONOUS,))
+        self.db.execute('PRAGMA wal_autocheckpoint = %i'%(config.WAL_AUTOCHECKPOINT,))
+        self.db.execute('PRAGMA mmap_size = %i'%(config.MMAP_SIZE,))
+        self.wal = self._pragma_read('journal_mode') == 'wal'
         self.table = tablename
         self.drop_key = object()
+        # when the current index builds and deletes started, and how many
+        # rows they have handled, and left to handle
+        self._progress = {}
+        self._remaining = {}
+        self._bulk = None
+        self._backup = None
+        self._keys = None
+        if config.KEY_WORKERS and not readonly:
+            self._keys = KeyPool(config)
+        self.documents = None
+        if config.DOCUMENT_CACHE_ENTRIES or config.DOCUMENT_CACHE_BYTES:
+            # Cached documents are shared between calls to get(), so they
+            # must not be modified.
+            self.documents = LRUCache(config.DOCUMENT_CACHE_ENTRIES, config.DOCUMENT_CACHE_BYTES)
         self._setup()
+        if not readonly:
+            self._upgrade()
+            # bulk builds don't survive restarts, those indexes get built
+            # incrementally instead
+            with self.db as cursor:
+                cursor.execute('UPDATE _indexes SET flags = flags & ~? WHERE flags & ?',
+                    (self.INDEX_FLAGS.bulk, self.INDEX_FLAGS.bulk))
+            self._refresh_indexes()
+            if self.metadata.get('format') != config.DOCUMENT_FORMAT:
+                # documents are written in the new format from now on
+                with self.db as cursor:
+                    self.metadata.set('format', config.DOCUMENT_FORMAT, conn=cursor)
+            self._train_dictionary()
+        self.data_version = self._pragma_read('data_version')
+        # compact() replaces the file
+        self.inode = os.stat(self.dbfile).st_ino
+        if readonly:
+            self.db.execute('PRAGMA query_only = 1')
 
     def _setup(self):
         # create the index listing if it doesn't exist
@@ -118,44 +547,101 @@ class TableAdapter(object):
         self.indexes = IndexInfo(self.db)
 
         # handle this table's information
-        self.data = DataTable(self.db)
-        self.index = IndexTable(self.db)
+        self.metadata = MetadataTable(self.db)
+        self.dictionaries = DictionaryTable(self.db)
+        self.dictionaries.load()
+        self.data = DataTable(self.db, self._codec())
+        self.index = IndexTable(self.db, self.config.INDEX_WITHOUT_ROWID)
         self._refresh_indexes()
 
+    def _upgrade(self):
+        # Rebuilds the index tables of databases from before index rows
+        # referred to the rowids of their documents, and flags the indexes of
+        # databases from before multi-valued indexes and case sensitivity were
+        # flagged, in one transaction.
+        db = self.db
+        level = db.isolation_level
+        db.isolation_level = None
+        try:
+            # it reads before it writes, see _group_commit()
+            db.execute('BEGIN IMMEDIATE')
+            for table in [self.index] + self.index_tables.values():
+                table.upgrade(db)
+            if self.metadata.get('multiple_flagged', conn=db) is None:
+                # any of them may have more than one row per document, and
+                # their rows were packed with the old case sensitivity
+                db.execute('UPDATE _indexes SET flags = flags | ?',
+                    (self.INDEX_FLAGS.multiple | self.INDEX_FLAGS.case_swapped,))
+                self.metadata.set('multiple_flagged', '1', conn=db)
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.isolation_level = level
+
+    def _codec(self):
+        config = self.config
+        dictionary = self.dictionaries.latest() if config.COMPRESSION else None
+        return Codec(config.COMPRESSION, config.COMPRESSION_LEVEL, dictionary, config.DOCUMENT_FORMAT)
+
+    def _train_dictionary(self):
+        # Trains the dictionary that new documents are compressed with from
+        # COMPRESSION_DICTIONARY documents spread over the table, once it has
+        # that many.
+        samples = self.config.COMPRESSION_DICTIONARY
+        if not (self.config.COMPRESSION and samples) or self.data.codec.dictionary_id is not None:
+            return
+        if self.db.execute('SELECT COUNT(*) FROM (SELECT 1 FROM _data LIMIT ?)', (samples,)).fetchone()[0] < samples:
+            return
+        low, high = self.db.execute('SELECT MIN(rowid), MAX(rowid) FROM _data').fetchone()
+        documents = []
+        for i in xrange(samples):
+            for data, in self.db.execute('SELECT data FROM _data WHERE rowid >= ? ORDER BY rowid LIMIT 1',
+                    (low + (high - low) * i // samples,)):
+                # in the format that documents are now written in
+                documents.append(str(self.data.codec.adapter(data)))
+        dictionary = train_dictionary(documents)
+        if dictionary:
+            with self.db as cursor:
+                self.dictionaries.add(dictionary, conn=cursor)
+            self.data.codec = self._codec()
+
     def _refresh_indexes(self):
         # cache the known set of indexes
+        building = self.indexes_in_progress, self.indexes_being_removed
         self.known_indexes = []
         self.indexes_to_ids = {}
         self.indexes_in_progress = []
         self.indexes_being_removed = []
+        self.multi_valued = set()
+        self.case_swapped = set()
+        self.index_tables = {}
+        self._prefix_tables = {}
 
         indexes = self.indexes.select(('index_id', 'columns', 'flags', 'last_indexed'))
         for index_id, columns, flags, last_indexed in indexes:
+            if flags & self.INDEX_FLAGS.multiple:
+                self.multi_valued.add(index_id)
+            if flags & self.INDEX_FLAGS.case_swapped:
+                self.case_swapped.add(index_id)
+            if flags & self.INDEX_FLAGS.table:
+                table = SingleIndexTable(self.db, index_id, pack(index_id)[1:], self.config.INDEX_WITHOUT_ROWID)
+                self.index_tables[index_id] = self._prefix_tables[table.prefix] = table
             if flags & self.INDEX_FLAGS.deleting:
                 self.indexes_being_removed.append(index_id)
-            else:
+            elif not flags & self.INDEX_FLAGS.bulk:
                 if last_indexed < 2**63-1:
                     self.indexes_in_progress.append(columns)
             self.known_indexes.append(columns)
             self.indexes_to_ids[columns] = index_id
 
         self.known_indexes.sort()
-
-    def _col_def(self, columns):
-        # check for a valid index
-        if not columns:
-            raise IndexWarning("Cannot create null index")
-        # check for valid column names
-        columns = list(columns)
-        for i, column in enumerate(columns):
-            if not COL_REGEX.match(column) or column in BAD_NAMES:
-                raise ColumnException("Bad column name: %r", column)
-            columns[i] = column.strip('+')
-
-        if len(columns) != len(set(col.strip('-') for col in columns)):
-            raise IndexError("Cannot list the same column twice in an index")
-
-        return ','.join(columns) + ','
+        # there are more (or fewer) rows left when the indexes change
+        if building[0] != self.indexes_in_progress:
+            self._remaining.pop('index', None)
+        if building[1] != self.indexes_being_removed:
+            self._remaining.pop('delete', None)
 
     def _next_index_row(self, count, cursor):
         # gets the next row that should be indexed
@@ -163,9 +649,7 @@ class TableAdapter(object):
             return None, None
 
         # find the minimum row to be indexed
-        last_indexed = None
-        for last_indexed, in cursor.execute('''SELECT MIN(last_indexed) from _indexes'''):
-            break
+        last_indexed = self._min_last_indexed(cursor)
 
         # if there are none, update our cache, and return no row to index 
         if last_indexed in (None, 2**63-1):
@@ -184,21 +668,333 @@ class TableAdapter(object):
 
         # there wasn't a row to update with that time, so update the indexes
         # and our cache
-        self.indexes.update([('last_indexed', 2**63-1)], last_indexed=last_indexed)
+        self._set_last_indexed(2**63-1, last_indexed, self.db)
         self._refresh_indexes()
 
         return None, None
 
+    def _index_some(self, count):
+        '''
+        Indexes up to count of the rows that are missing from the indexes
+        being built.  Returns the number of rows, and whether any index rows
+        were written; 0 rows once the indexes are built.
+        '''
+        with self.db as cursor:
+            li, rows = self._next_index_row(count, cursor)
+            if not rows:
+                self._finished('index')
+                return 0, False
+            changes = self.db.total_changes
+            last_updated = li
+            for row in rows:
+                rowid, _id, data, last_updated = row
+                data['_id'] = _id
+                self.update(data, cursor, index_only=True)
+            changed = self.db.total_changes != changes
+            self._set_last_indexed(last_updated, li, cursor)
+        self._handled('index', len(rows))
+        return len(rows), changed
+
+    def _min_last_indexed(self, cursor):
+        # where the incremental build of indexes is at
+        return cursor.execute('SELECT MIN(last_indexed) FROM _indexes WHERE flags & ? = 0',
+            (self.INDEX_FLAGS.deleting | self.INDEX_FLAGS.bulk,)).fetchone()[0]
+
+    def _set_last_indexed(self, new, old, cursor):
+        cursor.execute('UPDATE _indexes SET last_indexed = ? WHERE last_indexed = ? AND flags & ? = 0',
+            (new, old, self.INDEX_FLAGS.deleting | self.INDEX_FLAGS.bulk))
+
+    def _start_bulk(self, index_id, columns):
+        # Starts a bulk build of a new index when the table is big enough,
+        # the documents written so far will be indexed by the build.
+        if self._bulk is not None or self.readonly or not self.config.BULK_INDEX_ROWS:
+            return False
+        rows, watermark = self.db.execute('SELECT MAX(rowid), MAX(last_updated) FROM _data').fetchone()
+        if watermark is None or rows < self.config.BULK_INDEX_ROWS:
+            return False
+        self._bulk = BulkIndexBuild(index_id, columns, watermark, self.config,
+            os.path.dirname(os.path.abspath(self.dbfile)), self._insert_index_rows, self._keys)
+        return True
+
+    def _bulk_some(self, count):
+        '''
+        Performs up to count steps of the bulk index build.  Returns the
+        number of steps, and whether any index rows were written; 0 steps
+        once the build is done.
+        '''
+        bulk = self._bulk
+        with self.db as cursor:
+            steps, changed = bulk.step(cursor, count)
+            if not steps:
+                bulk.finish(cursor, self._index_keys)
+                self._mark_multi_valued(bulk.multi, cursor)
+                # documents written during the build are caught up on
+                # incrementally, which finds them already indexed
+                cursor.execute('UPDATE _indexes SET flags = flags & ~?, last_indexed = ? WHERE index_id = ?',
+                    (self.INDEX_FLAGS.bulk, bulk.watermark, bulk.index_id))
+        if not steps:
+            self._stop_bulk()
+            self._refresh_indexes()
+            self._finished('bulk')
+            return 0, True
+        self._handled('bulk', steps)
+        return steps, changed
+
+    def backup(self, path):
+        '''
+        Starts copying the table to path, relative to the BACKUP_PATH in the
+        PATH of the configuration, which the copy replaces once it is
+        complete.  The copy is made a batch of rows at a time, between other
+        requests, and its progress is reported by info().  The table must be
+        in wal mode.
+        '''
+        self._check_backup()
+        self._backup = Backup(self.dbfile, self._backup_path(path))
+        return True
+
+    def _backup_path(self, path):
+        # Backups can be requested by any client of the server, so they stay
+        # in their own directory, away from the files of the tables and their
+        # journals.
+        root = os.path.realpath(os.path.join(self.config.PATH, self.config.BACKUP_PATH))
+        resolved = os.path.realpath(os.path.join(root, path))
+        tables = os.path.realpath(self.config.PATH)
+        if os.path.dirname(resolved) != root or root == tables or os.path.isdir(resolved):
+            raise InvalidOperation("Table %r can't be backed up to %r", self.table, path)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        return resolved
+
+    def compact(self):
+        '''
+        Starts rebuilding the table's file without fragmentation or free
+        pages, and with the BLOCK_SIZE and AUTOVACUUM of the configuration,
+        like VACUUM would, but a batch of rows at a time between other
+        requests.  Documents written while the copy is made are copied over
+        afterwards, then the copy replaces the table's file.  Adding or
+        dropping an index cancels it.  The table must be in wal mode.
+        '''
+        self._check_backup()
+        if self._bulk is not None or self.indexes_in_progress or self.indexes_being_removed:
+            raise InvalidOperation("Table %r can't be compacted while indexes are being built or deleted", self.table)
+        index_tables = [self.index.table_name] + [table.table_name for table in self.index_tables.itervalues()]
+        self._backup = Compaction(self.dbfile, index_tables, self.config)
+        return True
+
+    def _check_backup(self):
+        if self._backup is not None:
+            raise InvalidOperation("A backup or compaction of table %r is already in progress", self.table)
+        if not self.wal:
+            # it would have to be copied all at once
+            raise InvalidOperation("Table %r can only be backed up or compacted with JOURNAL_MODE = 'wal'", self.table)
+
+    def _stop_compaction(self):
+        if isinstance(self._backup, Compaction):
+            self._backup.close()
+            self._backup = None
+
+    def _snapshot_due(self, force=False):
+        return self._backup is not None
+
+    def _snapshot_some(self, count):
+        '''
+        Copies up to count rows of the backup in progress.  Returns the
+        number of rows, 0 once the backup is complete.
+        '''
+        copied = self._backup.step(count)
+        if not copied:
+            backup, self._backup = self._backup, None
+            if isinstance(backup, Compaction):
+                self.db.close()
+                backup.finish()
+                self._reopen()
+            else:
+                backup.finish()
+        return copied
+
+    def _reopen(self):
+        # after the file was replaced by a compaction
+        drop_key = self.drop_key
+        self.db.close()
+        if self._keys is not None:
+            self._keys.close()
+        self.__init__(self.dbfile, self.table, self.config, self.readonly)
+        self.drop_key = drop_key
+
+    def _flush(self):
+        # finish the backup that was asked for
+        while self._backup is not None:
+            self._snapshot_some(10000)
+
+    def _close(self):
+        # stops the key workers and bulk build when the processor exits
+        self._stop_bulk()
+        if self._keys is not None:
+            self._keys.close()
+
+    def _stop_bulk(self):
+        if self._bulk is not None:
+            self._bulk.close()
+            self._bulk = None
+
+    def _delete_some(self, count):
+        '''
+        Removes up to count index rows of the first index being deleted.
+        Returns the number of index rows removed, and whether the index is now
+        gone.
+        '''
+        to_delete = self.indexes_being_removed[0]
+        start, end = self._index_bounds(to_delete)
+        deleted = self.index.delete_some(start, end, count)
+        if not deleted:
+            with self.db as cursor:
+                self.indexes.delete(index_id=to_delete, conn=cursor)
+            self._refresh_indexes()
+            self._finished('delete')
+            return 0, True
+        self._handled('delete', deleted)
+        return deleted, False
+
+    def _index_bounds(self, index_id):
+        # the range of keys of an index's rows
+        return pack(index_id)[1:], pack(index_id+1)[1:]
+
+    def _index_table(self, index_id):
+        # the table that holds an index's rows
+        return self.index_tables.get(index_id, self.index)
+
+    def _insert_index_rows(self, rows, cursor):
+        # Index rows are (key, rowref) pairs, keys are stored as blobs.  The
+        # keys of indexes that have their own table are stored there, without
+        # their index id prefix.
+        if not self.index_tables:
+            return self.index.insert_many([(buffer(key), rowref) for key, rowref in rows], conn=cursor)
+        by_table = {}
+        for key, rowref in rows:
+            # the length of the packed index id is in its first byte
+            table = self._prefix_tables.get(key[:ord(key[0]) - 126], self.index)
+            by_table.setdefault(table, []).append((buffer(key, len(table.prefix)), rowref))
+        for table, table_rows in by_table.iteritems():
+            table.insert_many(table_rows, conn=cursor)
+
+    def _index_keys(self, rowref, cursor):
+        # maps the keys of a document's index rows to their tables
+        keys = {}
+        for table in [self.index] + self.index_tables.values():
+            for key, in table.select(('idata',), rowref=rowref, conn=cursor):
+                keys[table.prefix + str(key)] = table
+        return keys
+
+    def _delete_index_rows(self, rowref, cursor):
+        self.index.delete(rowref=rowref, conn=cursor)
+        for table in self.index_tables.itervalues():
+            table.delete(rowref=rowref, conn=cursor)
+
+    def _handled(self, kind, count):
+        self._progress.setdefault(kind, [time.time(), 0])[1] += count
+        if kind in self._remaining:
+            self._remaining[kind] = max(self._remaining[kind] - count, 0)
+
+    def _inserted(self, count):
+        # documents inserted during an incremental build are indexed by it
+        if 'index' in self._remaining:
+            self._remaining['index'] += count
+
+    def _finished(self, kind):
+        self._progress.pop(kind, None)
+        self._remaining.pop(kind, None)
+
+    def _count_remaining(self, kind):
+        # The rows left are counted the first time they're asked for, then
+        # kept up to date as batches complete and documents are inserted.
+        if kind not in self._remaining:
+            if kind == 'index':
+                last_indexed = self._min_last_indexed(self.db)
+                self._remaining[kind] = self.db.execute(
+                    'SELECT count(*) FROM _data WHERE last_updated > ?', (last_indexed,)).fetchone()[0]
+            else:
+                self._remaining[kind] = 0
+                for index_id in self.indexes_being_removed:
+                    start, end = self._index_bounds(index_id)
+                    self._remaining[kind] += self.db.execute(
+                        'SELECT count(*) FROM _index WHERE idata >= ? AND idata < ?',
+                        (buffer(start), buffer(end))).fetchone()[0]
+        return self._remaining[kind]
+
+    def _maintenance_info(self):
+        # How many rows remain to be indexed (or index rows to be deleted),
+        # and an estimate of how many seconds that will take, based on the
+        # progress made so far.
+        out = {}
+        remaining = {}
+        if self.indexes_in_progress:
+            remaining['index'] = self._count_remaining('index')
+        if self._bulk is not None:
+            remaining['bulk'] = self._bulk.remaining(self.db)
+        if self.indexes_being_removed:
+            remaining['delete'] = self._count_remaining('delete')
+        for kind in ('index', 'bulk', 'delete'):
+            if kind not in remaining:
+                out[kind] = None
+                continue
+            started, done = self._progress.get(kind, (None, 0))
+            eta = None
+            if done:
+                eta = remaining[kind] * (time.time() - started) / done
+            out[kind] = {'done': done, 'remaining': remaining[kind], 'eta': eta}
+        return out
+
+    def _mark_multi_valued(self, multi, cursor):
+        # Searches over indexes with at most one row per document can skip
+        # the DISTINCT, so remember the indexes that don't qualify.
+        for index_id in multi - self.multi_valued:
+            cursor.execute('UPDATE _indexes SET flags = flags | ? WHERE index_id = ?',
+                (self.INDEX_FLAGS.multiple, index_id))
+            self.multi_valued.add(index_id)
+
+    def _changed(self):
+        '''
+        Returns whether another connection has committed to the database since
+        the last call, refreshing the cached indexes and documents if so.
+        '''
+        if os.stat(self.dbfile).st_ino != self.inode:
+            self._reopen()
+            return True
+        version = self._pragma_read('data_version')
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        self._refresh_indexes()
+        self.dictionaries.load()
+        if self.documents is not None:
+            self.documents.clear()
+        return True
+
     def _pragma_read(self, pragma):
         with self.db as conn:
             for row, in conn.execute('PRAGMA %s' % pragma):
                 return row
 
-    def ping(self):
-        return "pong"
+    def _checkpoint(self):
+        # copies the write-ahead log back into the database without waiting
+        # on any readers
+        if self.wal:
+            for busy, log, checkpointed in self.db.execute('PRAGMA wal_checkpoint(PASSIVE)'):
+                return log - checkpointed
+
+    def _vacuum_some(self, count):
+        # Frees up to count pages with an incremental vacuum, if enough of
+        # them are free, returning how many were freed.  None if there wasn't
+        # enough to bother.
+        free = self._pragma_read('freelist_count')
+        if free < self.config.MINIMUM_VACUUM_BLOCKS:
+            return None
+        self.db.execute('PRAGMA incremental_vacuum(%i)'%(count,))
+        return free - self._pragma_read('freelist_count')
 
     def info(self):
         info = {}
+        info['backend'] = 'sqlite'
         info['indexes'] = self.known_indexes
         info['indexes_del'] = self.indexes_being_removed
         info['indexes_add'] = self.indexes_in_progress
@@ -210,6 +1006,20 @@ class TableAdapter(object):
         info['unused_size'] = info['page_size'] * info['freelist_count']
         info['cache_size'] = self._pragma_read('cache_size')
         info['auto_vacuum'] = self._pragma_read('auto_vacuum')
+        info['journal_mode'] = self._pragma_read('journal_mode')
+        info['synchronous'] = SYNCHRONOUS_MODES[self._pragma_read('synchronous')]
+        info['document_cache'] = self.documents.stats() if self.documents is not None else None
+        info['format'] = self.metadata.get('format')
+        info['compression'] = self.config.COMPRESSION
+        info['compression_dictionary'] = self.data.codec.dictionary_id
+        maintenance = self._maintenance_info()
+        info['index_build'] = maintenance['index']
+        info['index_bulk_build'] = maintenance['bulk']
+        info['index_delete'] = maintenance['delete']
+        progress = self._backup.progress() if self._backup is not None else None
+        compacting = isinstance(self._backup, Compaction)
+        info['backup'] = None if compacting else progress
+        info['compaction'] = progress if compacting else None
         return info
 
     def insert(self, data, cursor=None):
@@ -220,24 +1030,35 @@ class TableAdapter(object):
 
         All rows will be inserted, or no rows will be inserted.
         '''
+        multi = set()
         if isinstance(data, list):
             ret = []
-            iinsert = []
-            for drow in data:
-                rowref, row_count, index_rows = _index_rows(drow, self.indexes_to_ids, self.config)
+            keys = []
+            generated = itertools.repeat(None)
+            if self._keys is not None and len(data) >= self.config.KEY_POOL_THRESHOLD:
+                generated = self._keys.generate(data, self.indexes_to_ids, multi, swapped=self.case_swapped)
+            for drow, gen in itertools.izip(data, generated):
+                rowref, row_count, index_rows = _index_rows(drow, self.indexes_to_ids, self.config, multi, gen,
+                    self.case_swapped)
                 ret.append((rowref, row_count, len(index_rows)))
-                iinsert.extend(index_rows)
+                keys.append(index_rows)
             with _cursor(cursor or self.db) as cur:
-                self.data.insert_many(data, conn=cur)
-                self.index.insert_many(iinsert, conn=cur)
+                rowids = self.data.insert_many(data, conn=cur)
+                self._insert_index_rows([(key, rowid)
+                    for rowid, index_rows in itertools.izip(rowids, keys) for key in index_rows], cur)
+                self._mark_multi_valued(multi, cur)
+            self._inserted(len(data))
             return ret
 
-        rowref, row_count, index_rows = _index_rows(data, self.indexes_to_ids, self.config)
+        rowref, row_count, index_rows = _index_rows(data, self.indexes_to_ids, self.config, multi,
+            swapped=self.case_swapped)
 
         # insert the data, then insert the index rows
         with _cursor(cursor or self.db) as cur:
-            self.data.insert(data, conn=cur)
-            self.index.insert_many(index_rows, conn=cur)
+            rowid = self.data.insert(data, conn=cur)
+            self._insert_index_rows(zip(index_rows, itertools.repeat(rowid)), cur)
+            self._mark_multi_valued(multi, cur)
+        self._inserted(1)
 
         return rowref, row_count, len(index_rows)
 
@@ -251,9 +1072,17 @@ class TableAdapter(object):
             with _cursor(cursor or self.db) as cur:
                 return map(self.delete, id, itertools.repeat(cur, len(id)))
 
+        self._uncache(id)
         with _cursor(cursor or self.db) as cur:
-            self.data.delete(_id=id, conn=cur)
-            self.index.delete(rowref=id, conn=cur)
+            row = self.data.select_one(('rowid',), _id=id, conn=cur)
+            if not row:
+                return
+            if self._bulk is not None:
+                self._bulk.dirty.add(row[0])
+            if self._backup is not None:
+                self._backup.deleted(row[0])
+            self.data.delete(rowid=row[0], conn=cur)
+            self._delete_index_rows(row[0], cur)
 
     def update(self, data, cursor=None, index_only=False, shared=None):
         '''
@@ -270,50 +1099,44 @@ class TableAdapter(object):
             shared = {}
 
         rowref = data.pop('_id')
-        ops = data.pop('__ops', '')
-        operations = itertools.chain(data.iteritems(), [('__ops', ops)])
 
         # If the row was previously deleted, this will silently create it as
         # long as there are no operations on existing data.
-        _existing = self.get(rowref, cursor) or {}
-
-        for col, value in operations:
-            existing = _existing
-
-            if col != '__ops':
-                # handle simple assignment
-                col, existing = _resolve(col, existing, '=')
-                existing[col] = value
-                continue
-
-            # no operation, skip it
-            if not value:
-                continue
-
-            # actually perform an operation on the data
-            run_script(value, existing, shared)
+        _existing = self.data.select_one(('data', 'rowid'), _id=rowref, conn=cursor or self.db)
+        _existing, data_rowid = _existing if _existing else ({}, None)
+        self._uncache(rowref)
+        if self._bulk is not None and not index_only and data_rowid is not None:
+            self._bulk.dirty.add(data_rowid)
 
         # use the proper dictionary.
-        _existing.pop('_id', None)
-        data = _existing
+        data = _apply_update(_existing, data, shared)
 
-        existing_keys = dict((str(k),v) for k,v in self.index.select(('idata', 'rowid'), rowref=rowref))
+        existing_keys = {}
+        if data_rowid is not None:
+            existing_keys = self._index_keys(data_rowid, cursor or self.db)
         old_keys = set(existing_keys)
         indexes = self.indexes_to_ids
         if index_only:
             indexes = dict((index, self.indexes_to_ids[index]) for index in self.indexes_in_progress)
-        count, new_keys = generate_index_rows(data, indexes, self.config)
-        new_keys = set(new_keys)
+        multi = set()
+        count, new_keys = generate_index_rows(data, indexes, self.config, multi=multi, swapped=self.case_swapped)
+        # index rows are generated as buffers, but are read back as strings
+        new_keys = set(map(str, new_keys))
         to_add = new_keys - old_keys
 
         with _cursor(cursor or self.db) as cur:
             if not index_only:
                 self.data.update(data, rowref, conn=cur)
                 to_remove = old_keys - new_keys
-                if to_remove:
-                    self.index.delete(rowid=sorted(existing_keys[key] for key in to_remove), conn=cur)
-            if to_add:
-                self.index.insert_many(zip(to_add, itertools.repeat(rowref)), conn=cur)
+                by_table = {}
+                for key in to_remove:
+                    table = existing_keys[key]
+                    by_table.setdefault(table, []).append((buffer(key, len(table.prefix)), data_rowid))
+                for table, rows in by_table.iteritems():
+                    table.delete_rows(sorted(rows), conn=cur)
+            if to_add and data_rowid is not None:
+                self._insert_index_rows(zip(to_add, itertools.repeat(data_rowid)), cur)
+            self._mark_multi_valued(multi, cur)
 
         data['_id'] = rowref
         return data
@@ -326,30 +1149,86 @@ class TableAdapter(object):
             with _cursor(cursor or self.db) as cur:
                 return map(self.get, id, itertools.repeat(cur, len(id)))
 
+        if self.documents is not None:
+            r = self.documents.get(id)
+            if r is not None:
+                return r
+
         with _cursor(cursor or self.db) as cur:
-            r = self.data.select_one(('data',), _id=id)
+            r = self._read(id, cur)
             if r:
-                r = r[0]
+                r, size = r
                 r['_id'] = id
+                if self.documents is not None:
+                    self.documents.put(id, r, size)
                 return r
 
+    def _read(self, id, conn):
+        # reads a row and its encoded size, without using the document cache
+        return self.data.select_one(('data', 'length(data)'), _id=id, conn=conn)
+
+    def _uncache(self, id):
+        if self.documents is not None:
+            self.documents.discard(id)
+
+    def _group_commit(self, requests):
+        '''
+        Performs the (operation, args, kwargs) mutations from the requests
+        iterable in a single transaction, each inside of its own savepoint so
+        that a failed request doesn't affect the others.  Returns a list of
+        (value, exception) pairs, one for each request, after the commit.
+        '''
+        results = []
+        db = self.db
+        # Python's sqlite3 would otherwise commit before every savepoint.
+        level = db.isolation_level
+        db.isolation_level = None
+        try:
+            cur = db.cursor()
+            # Inserts read before they write, and in wal mode, a transaction
+            # that has to wait to start writing fails instead.
+            cur.execute('BEGIN IMMEDIATE')
+            for operation, args, kwargs in requests:
+                cur.execute('SAVEPOINT request')
+                try:
+                    kwargs = dict(kwargs, cursor=cur)
+                    value = getattr(self, operation)(*args, **kwargs)
+                except Exception as e:
+                    cur.execute('ROLLBACK TO request')
+                    results.append((None, e))
+                else:
+                    results.append((value, None))
+                cur.execute('RELEASE request')
+            try:
+                cur.execute('COMMIT')
+            except Exception as e:
+                # nothing was written, so every request failed
+                cur.execute('ROLLBACK')
+                results = [(None, e) for value in results]
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.isolation_level = level
+        return results
+
     def add_index(self, *columns):
         '''
         Adds an index on the provided columns if it does not already exist.
         '''
-        index_def = self._col_def(columns)
-        # check for duplicate indexes
-        index_check = bisect.bisect_left(self.known_indexes, index_def)
-        if index_check < len(self.known_indexes):
-            if self.known_indexes[index_check].startswith(index_def):
-                raise IndexWarning("New index %r is a prefix of existing index %r",
-                    index_def, self.known_indexes[index_check])
+        index_def = self._new_index_def(columns)
+        # the compaction wouldn't copy the new index rows
+        self._stop_compaction()
 
         # push the index changes to the backend
         index_id = self.indexes.select_one(("max(index_id)",))
         index_id = index_id[0] if index_id else None
         index_id = 0 if index_id is None else index_id + 1
-        self.indexes.insert((index_id, index_def, 0, 0.0), "OR ROLLBACK")
+        flags = self.INDEX_FLAGS.bulk if self._start_bulk(index_id, index_def) else 0
+        if self.config.INDEX_TABLES:
+            flags |= self.INDEX_FLAGS.table
+            SingleIndexTable(self.db, index_id, pack(index_id)[1:], self.config.INDEX_WITHOUT_ROWID).create()
+        self.indexes.insert((index_id, index_def, flags, 0.0), "OR ROLLBACK")
 
         self._refresh_indexes()
 
@@ -362,21 +1241,31 @@ class TableAdapter(object):
         row = self.indexes.select_one(('index_id',), columns=index_def)
         if row:
             index_id, = row
-            self.indexes.update([('flags', self.INDEX_FLAGS.deleting)], index_id=index_id)
+            self._stop_compaction()
+            if self._bulk is not None and self._bulk.index_id == index_id:
+                self._stop_bulk()
+            if index_id in self.index_tables:
+                # nothing to clean up later
+                with self.db as cursor:
+                    self.index_tables[index_id].drop(cursor)
+                    self.indexes.delete(index_id=index_id, conn=cursor)
+            else:
+                self.indexes.update([('flags', self.INDEX_FLAGS.deleting)], index_id=index_id)
             self._refresh_indexes()
 
-    def get_drop_key(self):
-        '''
-        Generates a new key to drop the table.
-        '''
-        self.drop_key = new_uuid()
-        return self.drop_key
-
     def drop_table(self, key):
         '''
         Drops the table if the proper key is provided.
         '''
         if key == self.drop_key:
+            self._stop_bulk()
+            if self._backup is not None:
+                self._backup.close()
+                self._backup = None
+            if self._keys is not None:
+                self._keys.close()
+            if self.documents is not None:
+                self.documents.clear()
             self.db.close()
             for i in xrange(10):
                 try:
@@ -385,34 +1274,28 @@ class TableAdapter(object):
                     time.sleep(.1)
                 else:
                     break
+            # closing should have cleaned these up, but just in case
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(self.dbfile + suffix):
+                    os.remove(self.dbfile + suffix)
             return True
         else:
             return False
 
-    def search(self, filters, order=(), limit=None):
+    def _search_rows(self, filters, order, limit, sort=False):
         '''
-        Search the table with the provided filters, order, and limit.
-
-        Filters are of the form:
-            [('name', 'comparison', value), ...]
-        With 'comparison' being one of: '=', '<', '<=', '>', '>=', or 'IN' .
-
-        You may not use IN as part of a query that also includes any one or
-        more of <, <=, >, >=.
-
-        Orders are optional order clauses, which are specified as a sequence:
-            ['colname', '-colname', ...]
-        Where 'colname' is the standard sort order of the column, and
-        '-colname' is the reverse sort order of the column.  These order
-        clauses can help to choose a specific index if more than one index
-        could satisfy the query.
-
-        Limit is either a numeric limited number of rows to return (defaulting
-        and limited to at most 1000, or when provided as a tuple, is the
-        (offset,limit) .
+        Searches with a single filter list.  If sort is true, rows will be
+        returned in the order of the order columns, even if the chosen index
+        would order them by a range-filtered column first.
         '''
-        # todo: check and set limit clause
-        query, args = self._gen_query_sql(filters, order, limit)
+        if sort and order and [f for f in filters if f[1] != '=']:
+            return self._search_top(filters, order, limit)
+        try:
+            query, args = self._gen_query_sql(filters, order, limit, checked=True)
+        except TableIndexError:
+            if not order:
+                raise
+            return self._search_top(filters, order, limit)
         with self.db as conn:
             out = list(conn.execute(query, args))
         for i, (data, id) in enumerate(out):
@@ -420,176 +1303,127 @@ class TableAdapter(object):
             data['_id'] = id
         return out
 
+    def _search_top(self, filters, order, limit):
+        '''
+        Searches using an index that only satisfies the filters, keeping the
+        first offset+limit rows by the requested order in a bounded heap.
+        '''
+        offset, limit = limit if isinstance(limit, tuple) else (0, limit)
+        query, args = self._gen_query_sql(filters, (), checked=True)
+        key = _order_key(order)
+        def keyed(rows):
+            for data, id in rows:
+                k = key(data)
+                if k is not None:
+                    data['_id'] = id
+                    yield k, data
+        with self.db as conn:
+            out = heapq.nsmallest(offset + limit, keyed(conn.execute(query, args)),
+                key=lambda row: row[0])
+        return [data for k, data in out[offset:]]
+
     def count(self, filters, order=(), limit=None):
         '''
         Like search, only returning the total count (with an optional limit
         clause).
         '''
-        query, args = self._gen_query_sql(filters, order, limit, count=True)
-        sel, fro, rest = query.partition(' ( ')
-        rest, order, clause = rest.partition(' ORDER BY ')
-        query = rest.replace('DISTINCT', 'count(DISTINCT').replace(' _id', ')', 1)
-        if limit:
-            # want to count the items at an offset or up to a specific limit
-            order, lim, lclause = clause.partition(' LIMIT ')
-            query = query + ' ORDER BY ' + order + lim + lclause
+        limit = _parse_limit(limit, True)
+        queries = []
+        args = ()
+        for branch in _disjunction(filters):
+            index_id, reverse, where, wargs = self._index_range(branch, order)
+            distinct = 'DISTINCT ' if index_id in self.multi_valued else ''
+            _i = self._index_table(index_id).table_name
+            queries.append((distinct, _i, _i, where))
+            args += wargs
+        if not queries:
+            return 0
+        if len(queries) == 1 and not limit:
+            query = 'SELECT count(%s%s.rowref) FROM %s WHERE %s' % queries[0]
+        else:
+            queries = ['SELECT %s%s.rowref FROM %s WHERE %s' % q for q in queries]
+            # A UNION only keeps distinct rows, and want to count the items at
+            # an offset or up to a specific limit.
+            query = 'SELECT count(*) FROM (%s%s)' % (' UNION '.join(queries), _limit_clause(limit))
         with self.db as conn:
             for count, in conn.execute(query, args):
                 return count
         return None
 
-    def _gen_query_sql(self, filters, order, limit=None, count=False):
-        # adjust the limit clause
-        if limit is not None:
-            if isinstance(limit, (list, tuple)):
-                if len(limit) != 2:
-                    raise MalformedFilterError("bad limit clause")
-                offset, limit = map(int, limit)
-                limit = min(max(limit, 1), 1000)
-                limit = offset, limit
-            else:
-                limit = min(max(int(limit), 1), 1000)
-        elif not count:
-            limit = 1000
-
-        # find an index/order
-        usable_indexes = []
-        for prefix_regexp in filter_prefixes(filters, order):
-            usable_indexes.append([index for index in self.known_indexes if prefix_regexp.match(index)])
-        try:
-            use_index = sorted(sum(usable_indexes, []), key=lambda i:i.count(','))[0]
-        except IndexError:
-            raise TableIndexError("no known indexes match specified query")
-        reverse = use_index not in usable_indexes[0]
-        index_cols = use_index.rstrip(',').split(',')
-        # If there exists a minimal index to do what we want (in terms of
-        # fewest columns), we will have found it.
-
-        cols = filter_prefix(filters).count(',')
-        prefix = cols * [None]
-        ok_mini = ['>=', '>']
-        ok_maxi = ['<=', '<']
-        in_query = False
-        neq_query = False
-        # mini and maxi will have a shared prefix of data, with an optional
-        # minimum and maximum value with comparisons.
-        index = -1
-
-        # generate the prefix for our queries
-        lc = None
-        for col, comparison, value in filters:
-            if lc != col:
-                index += 1
-            lc = col
-            if comparison == 'IN':
-                in_query = True
-                # value is a tuple
-                prefix[index] = value
-            elif comparison == '=':
-                if prefix[index] is not None:
-                    raise MalformedFilterError("bad filters")
-                if neq_query or in_query:
-                    raise MalformedFilterError("bad filters")
-                prefix[index] = value
-            elif comparison in ('<=', '<'):
-                if in_query or (neq_query and not isinstance(prefix[index], list)):
-                    raise MalformedFilterError("bad filters")
-                neq_query = True
-                if prefix[index] is not None:
-                    prefix[index][1] = value
-                else:
-                    prefix[index] = [None, value]
-                del ok_maxi[:ok_maxi.index(comparison)]
-            elif comparison in ('>=', '>'):
-                if in_query or (neq_query and not isinstance(prefix[index], list)):
-                    raise MalformedFilterError("bad filters")
-                neq_query = True
-                if prefix[index] is not None:
-                    prefix[index][0] = value
-                else:
-                    prefix[index] = [value, Some]
-                del ok_mini[:ok_mini.index(comparison)]
-
-        assert None not in prefix
-        if in_query + neq_query == 2:
-            raise MalformedFilterError("bad filters")
-
-        # create the data prefix for our query
-        for col_i, (column, value) in enumerate(zip(index_cols, prefix)):
-            is_range = isinstance(prefix[col_i], list)
-            col_neg = column.startswith('-')
-            cased = not column.endswith('-')
-            prefix[col_i] = pack(value, case_sensitive=cased, neg=col_neg)
-            if is_range and col_neg:
-                lmi = len(ok_mini)
-                lma = len(ok_maxi)
-                ok_mini = ['>=', '>'][-lma:]
-                ok_maxi = ['<=', '<'][-lmi:]
-                prefix[col_i].reverse()
-
-        # inject the index id
-        index_id = self.indexes_to_ids[use_index]
-        prefix.insert(0, pack(index_id)[1:])
-
-        suffix = None
-        if not isinstance(prefix[-1], str):
-            suffix = prefix.pop()
-        like = ''.join(prefix)
-        _i = '_index'
+    def exists(self, filters):
+        '''
+        Returns whether any row matches the provided filters (of the same form
+        as search), without reading or decoding any of the rows.  Filtering
+        only on '_id' with '=' or 'IN' will check the data table directly.
+        '''
+        with self.db as conn:
+            for branch in _disjunction(filters):
+                # (filters decoded from JSON are lists)
+                if len(branch) == 1 and tuple(branch[0][:2]) == ('_id', '='):
+                    if self.data.select_one(('1',), _id=branch[0][2], conn=conn):
+                        return True
+                    continue
+                index_id, reverse, where, args = self._index_range(branch, ())
+                query = 'SELECT 1 FROM %s WHERE %s LIMIT 1' % (self._index_table(index_id).table_name, where)
+                for row in conn.execute(query, args):
+                    return True
+        return False
+
+    def _gen_query_sql(self, filters, order, limit=None, checked=False):
+        if not checked:
+            limit = _parse_limit(limit)
+        index_id, reverse, query, args = self._index_range(filters, order)
+        _i = self._index_table(index_id).table_name
         _t = '_data'
-        query = '''
-            SELECT %(_t)s.data, %(_t)s._id
-                FROM %(_t)s
-                INNER JOIN (
-                    SELECT DISTINCT %(_i)s.rowref _id
-                    FROM %(_i)s
-                    WHERE ''' % locals()
-        if suffix is None:
-            suffix = [None, None]
-        if isinstance(suffix, list):
-            args = []
-            # We would use LIKE here (for prefix equalities), but LIKE may not
-            # use indexes, at least for 2.8.6, no idea for the 3 series:
-            # http://web.utk.edu/~jplyon/sqlite/SQLite_optimization_FAQ.html
-            # We're going to convert LIKE into a pair of comparisons, which
-            # should keep things fast, regardless.
-
-            # Do the > or >= part...
-            args.append(like)
-            if suffix[0] != None:
-                args[-1] += suffix[0]
-            if ok_mini[0] == '>':
-                ok_mini[0] = '>='
-                args[-1] = _add_one(args[-1])
-            query += '''%s.idata >= ? AND ''' % (_i,)
-
-            # Do the < or <= part...
-            if suffix[1] == None:
-                ok_maxi.pop(0)
-                like = _add_one(like)
-                args.append(like)
-            else:
-                args.append(like + suffix[1])
-            query += '''%s.idata %s ? ''' % (_i, ok_maxi[0])
-
-        elif isinstance(suffix, tuple):
-            # IN queries
-            args = []
-            query += '''%s.idata IN ? ''' % _i
-            for d in suffix:
-                args.append(like + d)
-            args = [tuple(args)]
-
-        # handle order by clause
-        query += ''' ORDER BY %s.idata %s'''% (_i, 'DESC' if reverse else '')
 
-        # and offset/limits
-        if limit:
-            if isinstance(limit, tuple):
-                query += ''' LIMIT %i,%i'''%limit
-            else:
-                query += ''' LIMIT %i'''%(limit,)
-        query += ' ) SUB ON %s._id = SUB._id;' % (_t,)
+        # handle order by clause and offset/limits
+        query += ''' ORDER BY %s.idata %s'''% (_i, 'DESC' if reverse else '')
+        query += _limit_clause(limit)
+
+        if index_id in self.multi_valued:
+            query = '''
+                SELECT %(_t)s.data, %(_t)s._id
+                    FROM %(_t)s
+                    INNER JOIN (
+                        SELECT DISTINCT %(_i)s.rowref rowref
+                        FROM %(_i)s
+                        WHERE %(query)s
+                    ) SUB ON %(_t)s.rowid = SUB.rowref;''' % locals()
+        else:
+            # Every document has at most one row in this index, so we can walk
+            # the index in order and look up each document as we go, without
+            # needing a temporary b-tree for the DISTINCT.
+            query = '''
+                SELECT %(_t)s.data, %(_t)s._id
+                    FROM %(_i)s
+                    CROSS JOIN %(_t)s ON %(_t)s.rowid = %(_i)s.rowref
+                    WHERE %(query)s;''' % locals()
 
         # clean up the spacing and return
-        return ' '.join(query.split()), tuple(map(buffer, args))
+        return ' '.join(query.split()), args
+
+    def _index_range(self, filters, order):
+        '''
+        Chooses an index for the filters and order, returning the index id,
+        whether the index should be scanned in reverse, and the WHERE clause
+        (with its arguments) for the range of the index's rows to scan.
+        '''
+        index_id, reverse, lower, upper, upper_op = self._key_range(filters, order)
+        _i = self._index_table(index_id).table_name
+        if index_id not in self.index_tables:
+            # inject the index id
+            id_prefix = pack(index_id)[1:]
+            lower = id_prefix + lower
+            if upper is None:
+                upper, upper_op = _add_one(id_prefix), '<'
+            else:
+                upper = id_prefix + upper
+        query = '''%s.idata >= ? AND ''' % (_i,)
+        args = [lower]
+        if upper is None:
+            # the whole of an index that has its own table
+            query += '1 '
+        else:
+            query += '''%s.idata %s ? ''' % (_i, upper_op)
+            args.append(upper)
+        return index_id, reverse, query, tuple(map(buffer, args))
@@ -13,6 +13,7 @@ from embedded import Database
 from lib import adapt
 from lib.conf import load_settings, AttrDict
 from lib import default_config
+from lib import exceptions
 from thirdparty.recipe_440665_1 import RequestHandler, Server
 
 IDS = itertools.count()
@@ -34,8 +35,13 @@ class DatabaseHandler(Database):
         '''
         # set up all of the necessary processors/queues
         self._socket_ids[sock.id] = sock
-        outgoing = self._get_or_setup_command_queue(table_name)
-        outgoing.put((sock.id, rid, operation, args, kwargs))
+        outgoing = self._get_or_setup_command_queue(table_name, operation)
+        try:
+            self._send(outgoing, table_name, (sock.id, rid, operation, args, kwargs))
+        except exceptions.Overloaded as e:
+            # let the client know right away, so that it can back off
+            sock.respond(rid, {'exception':e.__class__.__name__, 'table_name':table_name, 'args':e.args})
+            return
         self._pending_responses += 1
 
     def _route_responses(self):
@@ -45,6 +51,9 @@ class DatabaseHandler(Database):
             sid, rid, response = self._incoming_responses.get()
             if sid:
                 self._pending_responses -= 1
+            elif response.get('response') == 'quit' and not response.get('readonly'):
+                # a dropped table's readers would otherwise keep it open
+                self._stop_readers(response['table_name'])
             sock = self._socket_ids.get(sid)
             if sock:
                 sock.respond(rid, response)
@@ -1,12 +1,16 @@
 
+import multiprocessing
 import os
+import Queue
 import sys
+import threading
 import time
 import unittest
 
 import embedded
 from .lib import default_config
 from .lib import exceptions
+from .lib import processor
 
 class TestEmbedded(unittest.TestCase):
     def setUp(self):
@@ -115,6 +119,205 @@ class TestEmbedded(unittest.TestCase):
         self.assertTrue(inf['cache_size'] == default_config.CACHE_SIZE)
         self.assertTrue(inf['auto_vacuum'] == default_config.AUTOVACUUM)
 
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        default_config.QUERY_CACHE_ENTRIES = 10
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        global default_config
+        default_config = reload(default_config)
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_query_cache(self):
+        self.db.test.add_index('i')
+        self.db.test.insert([{'i':i} for i in xrange(10)])
+        for i in xrange(3):
+            self.assertEquals(self.db.test.count([('i', '>', 4)]), 5)
+        self.assertEquals(self.db.test.count(filters=[['i', '>', 4]]), 5)
+        self.db.test.insert({'i':20})
+        self.assertEquals(self.db.test.count([('i', '>', 4)]), 6)
+        stats = self.db.test.info()['query_cache']
+        self.assertEquals((stats['hits'], stats['misses']), (3, 2))
+
+class TestReadWorkers(unittest.TestCase):
+    def setUp(self):
+        default_config.JOURNAL_MODE = 'wal'
+        default_config.READ_WORKERS = 2
+        default_config.QUERY_CACHE_ENTRIES = 10
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        global default_config
+        default_config = reload(default_config)
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_read_workers(self):
+        self.db.test.add_index('i')
+        ids = self.db.test.insert([{'i':i} for i in xrange(10)])
+        self.assertEquals(len(self.db._readers['test']), 2)
+        # every reader sees the writes, and the index, that came before
+        for i in xrange(4):
+            self.assertEquals(self.db.test.count([('i', '>', 4)]), 5)
+            self.assertEquals(self.db.test.get(ids[0][0])['i'], 0)
+        self.db.test.update({'_id':ids[0][0], 'i':20})
+        for i in xrange(4):
+            self.assertEquals(self.db.test.count([('i', '>', 4)]), 6)
+            self.assertEquals(self.db.test.get(ids[0][0])['i'], 20)
+        # the writer reports the progress of its maintenance
+        reads = self.db._next_reader
+        self.assertEquals(self.db.test.info()['journal_mode'], 'wal')
+        self.assertEquals(self.db._next_reader, reads)
+
+class TestMemoryBackend(unittest.TestCase):
+    def setUp(self):
+        default_config.JOURNAL_MODE = 'wal'
+        default_config.READ_WORKERS = 2
+        default_config.TABLE_CONFIGURATION = {'test': {'BACKEND':'memory'}}
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        global default_config
+        default_config = reload(default_config)
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_memory_backend(self):
+        self.db.test.add_index('i')
+        ids = self.db.test.insert([{'i':i} for i in xrange(10)])
+        self.assertEquals(self.db.test.count([('i', '>', 4)]), 5)
+        self.db.test.update({'_id':ids[0][0], 'i':20})
+        self.assertEquals(self.db.test.search([('i', '>', 8)], ('-i',)), [{'_id':ids[0][0], 'i':20}, {'_id':ids[9][0], 'i':9}])
+        info = self.db.test.info()
+        self.assertEquals((info['backend'], info['documents']), ('memory', 10))
+        # there's nothing on disk to share with readers
+        self.assertEquals(self.db._readers.get('test'), None)
+        self.assertFalse(os.path.exists('test.sqlite'))
+
+    def test_snapshot_restart(self):
+        default_config.TABLE_CONFIGURATION['test']['SNAPSHOT_INTERVAL'] = 60
+        self.db.test.add_index('i')
+        ids = self.db.test.insert([{'i':i} for i in xrange(10)])
+        # the snapshot is taken on the way out
+        self.db.shutdown_when_done()
+        self.db = embedded.Database(default_config)
+        self.assertEquals(self.db.test.get(ids[3][0]), {'_id':ids[3][0], 'i':3})
+        self.assertEquals(self.db.test.count([('i', '>', 4)]), 5)
+
+class TestLanes(unittest.TestCase):
+    def setUp(self):
+        default_config.MUTATION_SLICE_SIZE = 10
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        global default_config
+        default_config = reload(default_config)
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_lane_order(self):
+        q = Queue.Queue()
+        queue = processor.QueueWrapper(q, {'read':0, 'write':10, 'admin':20})
+        q.put((None, None, '_quit', (), {}))
+        q.put((1, 1, 'add_index', ('i',), {}))
+        q.put((1, 2, 'insert', ({},), {}))
+        q.put((1, 3, 'get', ('x',), {}))
+        q.put((1, 4, 'search', ([],), {'_priority':'admin'}))
+        self.assertEquals(queue.qsize(), 5)
+        order = [queue.get()[1] for i in xrange(5)]
+        self.assertEquals(order, [3, 2, 1, 4, None])
+
+    def test_expired(self):
+        q = Queue.Queue()
+        expired = []
+        queue = processor.QueueWrapper(q, expired=expired.append)
+        q.put((1, 1, 'get', ('x',), {'_deadline':time.time() - 1}))
+        q.put((1, 2, 'get', ('y',), {'_deadline':time.time() + 60}))
+        self.assertEquals(queue.get(), (1, 2, 'get', ('y',), {}))
+        self.assertEquals(expired, [(1, 1, 'get', ('x',), {})])
+        self.assertRaises(Queue.Empty, lambda: queue.get(False))
+        id = self.db.test.insert({})[0]
+        self.assertEquals(self.db.test.get(id, _timeout=60), {'_id':id})
+
+    def test_overloaded(self):
+        q = multiprocessing.Queue(1)
+        q.put(None)
+        try:
+            self.assertRaises(exceptions.Overloaded,
+                lambda: self.db._send(q, 'test', (1, 1, 'get', ('x',), {})))
+        finally:
+            # the queue's feeder thread would otherwise write to a closed pipe
+            q.get()
+            q.close()
+            q.join_thread()
+
+    def test_sliced_mutations(self):
+        d = [{'i':i} for i in xrange(95)]
+        ids = self.db.test.insert(d)
+        self.assertEquals(len(ids), 95)
+        self.assertEquals(self.db.test.get(ids[94][0]), {'i':94, '_id':ids[94][0]})
+        d = [{'_id':ids[i][0], 'i':-i} for i in xrange(25)]
+        # a failed slice leaves the earlier slices in place
+        d[15] = {'_id':ids[15][0], '__ops':'(getv `missing `value)'}
+        self.assertRaises(exceptions.UnknownExceptionError, lambda: self.db.test.update(d))
+        self.assertEquals(self.db.test.get(ids[9][0])['i'], -9)
+        self.assertEquals(self.db.test.get(ids[20][0])['i'], 20)
+        self.assertEquals(self.db.test.delete([id for id, c, ic in ids]), 95*[None])
+
+class TestMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_index_under_load(self):
+        self.db.test.insert([{'i':i} for i in xrange(2000)])
+        running = [1]
+        def load():
+            while running:
+                self.db.test.get('missing')
+        threads = [threading.Thread(target=load) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            self.db.test.add_index('i')
+            start = time.time()
+            while self.db.test.info()['index_build'] and time.time() - start < 30:
+                time.sleep(.1)
+            self.assertEquals(self.db.test.count([('i', '<', 10)]), 10)
+        finally:
+            del running[:]
+            for thread in threads:
+                thread.join()
+
+class TestKeyWorkers(unittest.TestCase):
+    def setUp(self):
+        default_config.KEY_WORKERS = 2
+        default_config.KEY_POOL_THRESHOLD = 10
+        self.db = embedded.Database(default_config)
+
+    def tearDown(self):
+        global default_config
+        default_config = reload(default_config)
+        self.db.test.drop_table(self.db.test.get_drop_key())
+        self.db.shutdown_with_kill()
+
+    def test_key_workers(self):
+        self.db.test.add_index('i')
+        self.db.test.insert([{'i':i} for i in xrange(50)])
+        self.assertEquals(self.db.test.count([('i', '<', 10)]), 10)
+        # the processor stops its workers on the way out
+        table_processor = self.db._processors['test']
+        self.db.shutdown_when_done()
+        table_processor.join(10)
+        self.assertEquals(table_processor.exitcode, 0)
+        self.db = embedded.Database(default_config)
+        self.assertEquals(self.db.test.count([('i', '<', 10)]), 10)
+
 class TestAutovacuum(unittest.TestCase):
     def setUp(self):
         try:
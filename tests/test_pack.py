@@ -82,6 +82,23 @@ class TestPacking(unittest.TestCase):
         self._verify(d, neg=True)
         self._verify(d, cs=False, neg=True)
 
+    def test_pack_prefix(self):
+        # packed strings should fall in the packed range of their prefixes,
+        # and only those (trailing nulls are indistinguishable from padding)
+        d = [u''.join(unichr(random.choice((1, 65, 97, 0x394, 0xd7af))) for i in xrange(random.randrange(6)))
+            for j in xrange(300)]
+        for cs in (True, False):
+            for neg in (False, True):
+                packed = [(s, pack.pack(s, case_sensitive=cs, neg=neg)) for s in d]
+                for prefix in d[:30]:
+                    start, end = pack.pack_prefix(prefix, case_sensitive=cs, neg=neg)
+                    if not cs:
+                        prefix = prefix.lower()
+                    for s, p in packed:
+                        if not cs:
+                            s = s.lower()
+                        self.assertEquals(start <= p < end, s.startswith(prefix), (prefix, s, cs, neg))
+
     def test_pack_sequence(self):
         data = (1, 40L, 1.4, decimal.Decimal('4.2'), 'hello', u'hello', None)
         seqa = pack.pack(data)
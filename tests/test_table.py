@@ -1,15 +1,18 @@
 
 import datetime
 import decimal
+import os
+import sqlite3
 import sys
 import time
 import unittest
 
+from .lib import backends
 from .lib import default_config
 from .lib import pack
 from .lib import table
 from .lib.exceptions import ColumnException, IndexRowTooLong, \
-    IndexWarning, TooManyIndexRows
+    IndexWarning, InvalidOperation, TableIndexError, TooManyIndexRows
 
 
 class TableAdapterTest(unittest.TestCase):
@@ -136,6 +139,501 @@ class TableAdapterTest(unittest.TestCase):
             '_id':ids[0],
             '__ops':'''(getv `does-not-exist `value)'''}]))
 
+    def test_search_order_without_index(self):
+        self.table.add_index('category')
+        data = [{'category':i % 2, 'score':(i * 7) % 10} for i in xrange(10)]
+        data.append({'category':0, 'score':[]})
+        self.table.insert(data)
+        self.assertRaises(TableIndexError, lambda: self.table.search([('score', '>', 0)], ('score',)))
+        out = self.table.search([('category', '=', 0)], ('-score',), 3)
+        self.assertEquals([d['score'] for d in out], [8, 6, 4])
+        out = self.table.search([('category', '=', 0)], ('score',), (1, 2))
+        self.assertEquals([d['score'] for d in out], [2, 4])
+
+    def test_single_valued_index(self):
+        self.table.add_index('i')
+        self.table.insert([{'i':i} for i in xrange(10)])
+        index_id = self.table.indexes_to_ids['i,']
+        self.assertFalse(index_id in self.table.multi_valued)
+        query, args = self.table._gen_query_sql([('i', '>', 2)], ('-i',), 3)
+        self.assertFalse('DISTINCT' in query)
+        self.assertEquals([d['i'] for d in self.table.search([('i', '>', 2)], ('-i',), 3)], [9, 8, 7])
+        self.table.insert({'i':[20, 21]})
+        self.assertTrue(index_id in self.table.multi_valued)
+        self.table._refresh_indexes()
+        self.assertTrue(index_id in self.table.multi_valued)
+        self.assertEquals([d['i'] for d in self.table.search([('i', '>', 8)], ('i',))], [9, [20, 21]])
+
+    def test_startswith(self):
+        self.table.add_index('name-')
+        self.table.add_index('-name', 'i')
+        names = ['Jos', 'josiah', 'Joseph', 'joy', 'Jo', 'jOSs']
+        self.table.insert([{'name':name, 'i':i} for i, name in enumerate(names)])
+        out = self.table.search([('name-', 'startswith', 'jos')])
+        self.assertEquals(sorted(d['name'] for d in out), ['Jos', 'Joseph', 'jOSs', 'josiah'])
+        self.assertEquals(self.table.count([('name-', 'startswith', 'JOS')]), 4)
+        out = self.table.search([('name', 'startswith', 'Jos')], ('-name',))
+        self.assertEquals([d['name'] for d in out], ['Joseph', 'Jos'])
+        self.assertEquals(self.table.search([('name', 'startswith', 'x')], ('name-',)), [])
+
+    def test_disjunctions(self):
+        self.table.add_index('status', 'score')
+        self.table.add_index('owner', 'score')
+        statuses = ['open', 'pending', 'closed']
+        data = [{'status':statuses[i % 3], 'owner':('me', 'you')[i % 2], 'score':i} for i in xrange(12)]
+        self.table.insert(data)
+        by_status = [('status', 'IN', ('open', 'pending'))]
+        self.assertEquals(self.table.count(by_status), 8)
+        self.assertEquals(sorted(d['score'] for d in self.table.search(by_status)),
+            [0, 1, 3, 4, 6, 7, 9, 10])
+        either = [by_status, [('owner', '=', 'me')]]
+        self.assertEquals(self.table.count(either), 10)
+        out = self.table.search(either, ('-score',), (1, 3))
+        self.assertEquals([d['score'] for d in out], [9, 8, 7])
+        out = self.table.search([('owner', '=', 'me'), ('score', '!=', 4)], ('score',))
+        self.assertEquals([d['score'] for d in out], [0, 2, 6, 8, 10])
+        out = self.table.search([('status', '!=', 'open')], ('-score',), 3)
+        self.assertEquals([d['score'] for d in out], [11, 10, 8])
+        self.assertEquals(self.table.count([('status', '=', 'open'), ('score', '!=', 6), ('score', '>=', 3)]), 2)
+        self.assertEquals(self.table.search([('status', 'IN', ())]), [])
+
+    def test_exists(self):
+        self.table.add_index('i')
+        ids = [row[0] for row in self.table.insert([{'i':i} for i in xrange(5)])]
+        self.assertTrue(self.table.exists([('i', '>=', 4)]))
+        self.assertFalse(self.table.exists([('i', '>', 4)]))
+        self.assertTrue(self.table.exists([[('i', '=', 7)], [('i', '=', 2)]]))
+        self.assertTrue(self.table.exists([('_id', '=', ids[0])]))
+        self.assertTrue(self.table.exists([('_id', 'IN', ('missing', ids[1]))]))
+        self.table.delete(ids[0])
+        self.assertFalse(self.table.exists([('_id', '=', ids[0])]))
+        # filters decoded from JSON are lists
+        self.assertTrue(self.table.exists([['_id', '=', ids[1]]]))
+        self.assertTrue(self.table.exists([['_id', 'IN', ['missing', ids[1]]]]))
+        self.assertFalse(self.table.exists([[['_id', '=', ids[0]]], [['i', '=', 7]]]))
+
+    def test_document_cache(self):
+        default_config.DOCUMENT_CACHE_ENTRIES = 2
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        ids = [row[0] for row in self.table.insert([{'i':i} for i in xrange(3)])]
+        self.assertEquals(self.table.get(ids[0]), {'i':0, '_id':ids[0]})
+        self.assertEquals(self.table.get(ids[0]), {'i':0, '_id':ids[0]})
+        self.table.update({'_id':ids[0], 'i':5})
+        self.assertEquals(self.table.get(ids[0]), {'i':5, '_id':ids[0]})
+        self.table.get(ids[1])
+        self.table.get(ids[2])
+        self.table.delete(ids[2])
+        self.assertEquals(self.table.get(ids[2]), None)
+        stats = self.table.info()['document_cache']
+        self.assertEquals((stats['hits'], stats['misses'], stats['evictions']), (1, 5, 1))
+        self.assertEquals(stats['entries'], 1)
+
+    def test_journal_mode(self):
+        default_config.JOURNAL_MODE = 'wal'
+        default_config.SYNCHRONOUS = 'normal'
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        info = self.table.info()
+        self.assertEquals((info['journal_mode'], info['synchronous']), ('wal', 'normal'))
+        self.table.insert({'i':1})
+        self.assertEquals(self.table._checkpoint(), 0)
+
+    def test_reindex_unchanged(self):
+        # re-indexing or updating rows keeps their existing index rows
+        self.table.add_index('i')
+        ids = [row[0] for row in self.table.insert([{'i':i} for i in xrange(3)])]
+        self.table.update({'_id':ids[0], 'i':0})
+        with self.table.db as cursor:
+            li, rows = self.table._next_index_row(10, cursor)
+            for rowid, _id, data, last_updated in rows:
+                data['_id'] = _id
+                self.table.update(data, cursor, index_only=True)
+        self.assertEquals(list(self.table.db.execute('SELECT rowid FROM _index')), [(1,), (2,), (3,)])
+
+    def test_maintenance_progress(self):
+        self.table.insert([{'i':i} for i in xrange(10)])
+        self.table.add_index('i')
+        info = self.table.info()
+        self.assertEquals(info['index_build'], {'done':0, 'remaining':10, 'eta':None})
+        self.assertEquals(info['index_delete'], None)
+        self.assertEquals(self.table._index_some(4), (4, True))
+        build = self.table.info()['index_build']
+        self.assertEquals((build['done'], build['remaining']), (4, 6))
+        self.assertTrue(build['eta'] >= 0)
+        # kept up to date without counting again
+        self.table.insert([{'i':10}, {'i':11}])
+        self.assertEquals(self.table._remaining['index'], 8)
+        self.assertEquals(self.table.info()['index_build']['remaining'], 8)
+        self.assertEquals(self.table._index_some(10), (8, True))
+        self.assertEquals(self.table._index_some(10), (0, False))
+        self.assertEquals(self.table.info()['index_build'], None)
+        self.assertEquals(self.table.count([('i', '>', 4)]), 7)
+
+        self.table.drop_index('i')
+        self.assertEquals(self.table.info()['index_delete'], {'done':0, 'remaining':12, 'eta':None})
+        self.assertEquals(self.table._delete_some(7), (7, False))
+        self.assertEquals(self.table.info()['index_delete']['remaining'], 5)
+        self.assertEquals(self.table._delete_some(7), (5, False))
+        self.assertEquals(self.table._delete_some(7), (0, True))
+        self.assertEquals(self.table.known_indexes, [])
+        self.assertEquals(self.table.info()['index_delete'], None)
+
+    def test_bulk_index_build(self):
+        default_config.BULK_INDEX_ROWS = 10
+        default_config.BULK_INDEX_RUN_SIZE = 7
+        data = [{'i':i % 17, 'j':[i, -i]} for i in xrange(50)]
+        ids = [row[0] for row in self.table.insert(data)]
+        self.table.add_index('i')
+        self.table.add_index('j')
+        self.assertTrue(self.table._bulk is not None)
+        self.assertEquals(self.table.indexes_in_progress, ['j,'])
+        self.assertEquals(self.table._bulk_some(20), (20, False))
+        # changes during the build
+        self.table.update({'_id':ids[0], 'i':100})
+        self.table.update({'_id':ids[40], 'i':101})
+        self.table.delete(ids[1])
+        self.table.insert({'_id':'new', 'i':3})
+        while self.table._bulk_some(20)[0]:
+            self.table.update({'_id':ids[2], 'i':102})
+        while self.table._index_some(20)[0]:
+            pass
+        self.assertEquals(self.table.indexes_in_progress, [])
+        index_id = self.table.indexes_to_ids['i,']
+        self.assertFalse(index_id in self.table.multi_valued)
+        self.assertTrue(self.table.indexes_to_ids['j,'] in self.table.multi_valued)
+        expected = {}
+        for d in data[3:40] + data[41:]:
+            expected[d['i']] = expected.get(d['i'], 0) + 1
+        expected[3] += 1
+        expected.update({100:1, 101:1, 102:1})
+        for i, count in expected.items():
+            self.assertEquals(self.table.count([('i', '=', i)]), count, i)
+        self.assertEquals(self.table.count([('i', '>=', 0)]), 50)
+        self.assertEquals(self.table.count([('j', '>=', 0)]), 49)
+        self.assertEquals(self.table.info()['index_bulk_build'], None)
+
+    def test_key_workers(self):
+        default_config.KEY_WORKERS = 2
+        default_config.KEY_POOL_THRESHOLD = 10
+        default_config.KEY_CHUNK_SIZE = 7
+        default_config.BULK_INDEX_ROWS = 10
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.add_index('i')
+        data = [{'i':i, 'j':[i, i+1]} for i in xrange(50)]
+        result = self.table.insert(data)
+        self.assertEquals([(count, icount) for id, count, icount in result], 50*[(1, 1)])
+        self.assertTrue(self.table._keys.pool is not None)
+        self.assertEquals(self.table.count([('i', '<', 10)]), 10)
+        self.assertRaises(IndexRowTooLong, lambda: self.table.insert(10*[{'i':1000*'x'}]))
+        # bulk builds skip the documents they can't index
+        self.table.insert({'j':1000*'x'})
+        self.table.add_index('j')
+        while self.table._bulk_some(20)[0]:
+            pass
+        self.assertTrue(self.table.indexes_to_ids['j,'] in self.table.multi_valued)
+        self.assertEquals(self.table.count([('j', '>=', 0)]), 50)
+        self.assertEquals(self.table.count([('j', '=', 10)]), 2)
+
+    def test_index_tables(self):
+        self.table.add_index('i')
+        default_config.INDEX_TABLES = True
+        self.table.add_index('j')
+        self.table.add_index('k', 'i')
+        index_id = self.table.indexes_to_ids['j,']
+        self.assertEquals(sorted(self.table.index_tables), [1, 2])
+        ids = [row[0] for row in self.table.insert([{'i':i, 'j':i % 3, 'k':[i, -i]} for i in xrange(30)])]
+        # keys of indexes with their own table don't carry the index id
+        self.assertEquals(self.table.db.execute('SELECT count(*) FROM _index').fetchone()[0], 30)
+        self.assertEquals(sorted(str(k) for k, in self.table.db.execute('SELECT DISTINCT idata FROM _index_1')),
+            sorted(pack.pack(i) for i in xrange(3)))
+        self.assertEquals(self.table.count([('j', '=', 1)]), 10)
+        self.assertEquals(self.table.count([('j', '>', 0)]), 20)
+        self.assertEquals(self.table.count([('k', '<', 0)]), 29)
+        self.assertEquals([d['j'] for d in self.table.search([('j', '<', 5)], ('-j',), 12)], 10*[2] + 2*[1])
+        self.assertTrue(self.table.exists([('k', '=', -29), ('i', '=', 29)]))
+        self.table.update({'_id':ids[1], 'j':5, 'k':[]})
+        self.assertEquals(self.table.count([('j', '=', 5)]), 1)
+        self.assertEquals(self.table.count([('k', '<', 0)]), 28)
+        self.table.delete(ids[2])
+        self.assertEquals(self.table.count([('j', '<', 10)]), 29)
+        # dropping an index with its own table is done at once
+        self.table.drop_index('j')
+        self.assertEquals(self.table.indexes_being_removed, [])
+        self.assertEquals(list(self.table.db.execute(
+            "SELECT name FROM sqlite_master WHERE name = '_index_%i'" % (index_id,))), [])
+        self.assertEquals(self.table.count([('i', '<', 10)]), 9)
+
+    def test_without_rowid(self):
+        default_config.INDEX_WITHOUT_ROWID = True
+        default_config.INDEX_TABLES = True
+        self.table.add_index('j')
+        sql, = self.table.db.execute("SELECT sql FROM sqlite_master WHERE name = '_index_0'").fetchone()
+        self.assertTrue('WITHOUT ROWID' in sql)
+        self.assertEquals([name for name, in self.table.db.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name = '_index_0' AND type = 'index' AND sql IS NOT NULL")],
+            ['_index_0_irowref'])
+        ids = [row[0] for row in self.table.insert([{'j':[i, i, i+1]} for i in xrange(10)])]
+        self.assertEquals(self.table.db.execute('SELECT count(*) FROM _index_0').fetchone()[0], 20)
+        self.assertEquals(self.table.count([('j', '=', 5)]), 2)
+        self.table.update({'_id':ids[5], 'j':[7]})
+        self.assertEquals(self.table.count([('j', '=', 5)]), 1)
+        self.assertEquals(self.table.count([('j', '=', 7)]), 3)
+        self.table.delete(ids[6])
+        self.assertEquals(self.table.count([('j', '=', 7)]), 2)
+
+    def test_rowref_upgrade(self):
+        self.table.add_index('i')
+        ids = [row[0] for row in self.table.insert([{'i':i} for i in xrange(10)])]
+        self.assertEquals(set(type(r) for r, in self.table.db.execute('SELECT rowref FROM _index')), set([int]))
+        # rewrite the index the way that older versions stored it
+        with self.table.db as db:
+            db.execute('ALTER TABLE _index RENAME TO _index_new')
+            db.execute('DROP INDEX _index_idata')
+            db.execute('DROP INDEX _index_irowref')
+            db.execute('CREATE TABLE _index (rowid INTEGER PRIMARY KEY, idata BLOB NOT NULL, rowref TEXT NOT NULL)')
+            db.execute('''
+                INSERT INTO _index (idata, rowref)
+                    SELECT idata, _data._id FROM _index_new INNER JOIN _data ON _data.rowid = _index_new.rowref''')
+            db.execute('DROP TABLE _index_new')
+        self.table.db.close()
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(set(type(r) for r, in self.table.db.execute('SELECT rowref FROM _index')), set([int]))
+        self.assertEquals([d['_id'] for d in self.table.search([('i', '<', 3)])], ids[:3])
+        self.table.update({'_id':ids[0], 'i':20})
+        self.assertEquals(self.table.count([('i', '<', 3)]), 2)
+
+    def test_multiple_upgrade(self):
+        self.table.add_index('tags')
+        _id = self.table.insert({'tags':['a', 'b', 'c']})[0]
+        self.table.insert({'tags':['d']})
+        while self.table._index_some(100)[0]:
+            pass
+        # the way that older versions stored the index
+        with self.table.db as db:
+            db.execute('UPDATE _indexes SET flags = 0')
+            db.execute('DROP TABLE _metadata')
+            db.execute('ALTER TABLE _index RENAME TO _index_new')
+            db.execute('DROP INDEX _index_idata')
+            db.execute('DROP INDEX _index_irowref')
+            db.execute('CREATE TABLE _index (rowid INTEGER PRIMARY KEY, idata BLOB NOT NULL, rowref TEXT NOT NULL)')
+            db.execute('''
+                INSERT INTO _index (idata, rowref)
+                    SELECT idata, _data._id FROM _index_new INNER JOIN _data ON _data.rowid = _index_new.rowref''')
+            db.execute('DROP TABLE _index_new')
+        self.table.db.close()
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(self.table.search([('tags', '>=', 'a'), ('tags', '<', 'd')]), [{'_id':_id, 'tags':['a', 'b', 'c']}])
+        self.assertEquals(self.table.count([('tags', '>=', 'a')]), 2)
+        # it's only done once
+        self.table.add_index('other')
+        self.table.insert({'other':1})
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(self.table.multi_valued, set([self.table.indexes_to_ids['tags,']]))
+
+    def test_case_upgrade(self):
+        self.table.add_index('name-')
+        self.table.add_index('-name', 'i')
+        # older versions packed 'col-' columns case sensitively, and the others
+        # case insensitively
+        with self.table.db as db:
+            db.execute('UPDATE _indexes SET flags = 0')
+            db.execute('DROP TABLE _metadata')
+        self.table.db.close()
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(self.table.case_swapped, set(self.table.indexes_to_ids.values()))
+        names = ['Jos', 'josiah', 'Joseph', 'joy', 'Jo', 'jOSs']
+        _ids = self.table.insert([{'name':name, 'i':i} for i, name in enumerate(names)])
+        self.table.update({'_id':_ids[3], 'name':'JOSE', 'i':3})
+        # the old indexes keep their convention
+        out = self.table.search([('name-', 'startswith', 'jos')])
+        self.assertEquals([d['name'] for d in out], ['josiah'])
+        out = self.table.search([('name', 'startswith', 'jos')], ('-name',))
+        self.assertEquals([d['name'] for d in out], ['jOSs', 'josiah', 'Joseph', 'JOSE', 'Jos'])
+        # and new ones get the new one
+        self.table.drop_index('-name', 'i')
+        self.table.add_index('name')
+        while self.table._index_some(100)[0]:
+            pass
+        self.assertEquals(self.table.case_swapped, set([self.table.indexes_to_ids['name-,']]))
+        out = self.table.search([('name', 'startswith', 'Jos')], ('name',))
+        self.assertEquals([d['name'] for d in out], ['Jos', 'Joseph'])
+
+    def test_group_commit(self):
+        self.table.add_index('i')
+        done = self.table._group_commit([
+            ('insert', ({'_id':'a', 'i':1},), {}),
+            # the duplicate _id fails, without undoing the others
+            ('insert', ([{'_id':'b', 'i':2}, {'_id':'a', 'i':2}],), {}),
+            ('update', ({'_id':'a', 'i':3},), {}),
+            ('insert', ({'_id':'c', 'i':4},), {}),
+            ('delete', ('c',), {}),
+        ])
+        self.assertEquals([e is None for value, e in done], [True, False, True, True, True])
+        self.assertEquals(done[0][0], ('a', 1, 1))
+        self.assertEquals(done[1][1].__class__.__name__, 'IntegrityError')
+        self.assertEquals(self.table.get(['a', 'b', 'c']), [{'_id':'a', 'i':3}, None, None])
+        self.assertEquals(self.table.count([('i', '>', 0)]), 1)
+        # and it was all committed
+        db = sqlite3.connect('test_table.sqlite')
+        self.assertEquals(list(db.execute('SELECT _id FROM _data')), [('a',)])
+        db.close()
+
+    def test_backup(self):
+        self.assertRaises(InvalidOperation, lambda: self.table.backup('test_table.backup'))
+        self.assertRaises(InvalidOperation, self.table.compact)
+        default_config.JOURNAL_MODE = 'wal'
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.add_index('i')
+        self.table.insert([{'_id':str(i), 'i':i} for i in xrange(100)])
+        for path in ('../test_backup', '/tmp/test_backup', '../test_table.sqlite', '../other_table.sqlite',
+                '../test_table.sqlite-wal', '../test_table.sqlite-shm', '../test_table.sqlite-journal',
+                '../test_table.sqlite.compact', '../TEST_TABLE.SQLITE', '.', 'sub/test_backup'):
+            self.assertRaises(InvalidOperation, lambda: self.table.backup(path))
+        self.assertTrue(self.table.backup('test_table.backup'))
+        self.assertRaises(InvalidOperation, lambda: self.table.backup('test_table.backup'))
+        self.assertEquals(self.table._snapshot_some(10), 10)
+        # writes made during the backup aren't part of it
+        self.table.delete('0')
+        self.table.insert({'_id':'new', 'i':-1})
+        self.assertEquals(self.table.info()['backup']['done'], 10)
+        while self.table._snapshot_some(50):
+            pass
+        self.assertEquals(self.table.info()['backup'], None)
+        # in BACKUP_PATH, away from the tables
+        self.assertFalse(os.path.exists('test_table.backup'))
+        copy = table.TableAdapter(os.path.join('backups', 'test_table.backup'), 'test_backup', default_config)
+        self.assertEquals(copy.count([('i', '<', 10)]), 10)
+        self.assertEquals(sorted(name for name, in copy.db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")),
+            [name for name, in self.table.db.execute("SELECT name FROM sqlite_master WHERE type = 'index' ORDER BY name")])
+        self.assertEquals(copy.get(['0', 'new']), [{'_id':'0', 'i':0}, None])
+        copy.drop_table(copy.get_drop_key())
+        os.rmdir('backups')
+
+    def test_compact(self):
+        default_config.JOURNAL_MODE = 'wal'
+        default_config.INDEX_TABLES = True
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.add_index('i')
+        self.table.insert([{'_id':str(i), 'i':i, 'pad':1000*'x'} for i in xrange(200)])
+        self.table.delete([str(i) for i in xrange(0, 200, 2)])
+        while self.table._index_some(100)[0]:
+            pass
+        self.assertTrue(self.table.compact())
+        self.assertRaises(InvalidOperation, lambda: self.table.backup('test_table.backup'))
+        reader = table.TableAdapter('test_table.sqlite', 'test_table', default_config, True)
+        inode = self.table.inode
+        self.assertEquals(self.table._snapshot_some(50), 50)
+        # writes made during the compaction are copied over afterwards
+        self.table.delete('1')
+        self.table.insert({'_id':'1', 'i':-1})
+        self.table.update({'_id':'3', 'i':-3})
+        while self.table._snapshot_some(50):
+            pass
+        self.assertEquals(self.table.info()['compaction'], None)
+        self.assertNotEquals(self.table.inode, inode)
+        self.assertEquals(self.table.count([('i', '<', 0)]), 2)
+        self.assertEquals(self.table.search([('i', '<', 10)]),
+            [{'_id':'3', 'i':-3, 'pad':1000*'x'}, {'_id':'1', 'i':-1}, {'_id':'5', 'i':5, 'pad':1000*'x'},
+             {'_id':'7', 'i':7, 'pad':1000*'x'}, {'_id':'9', 'i':9, 'pad':1000*'x'}])
+        self.assertEquals(self.table.info()['freelist_count'], 0)
+        # readers pick up the new file
+        self.assertTrue(reader._changed())
+        self.assertEquals(reader.count([('i', '<', 10)]), 5)
+        # as does anything else
+        copy = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(copy.get('1'), {'_id':'1', 'i':-1})
+
+    def test_compact_updates(self):
+        default_config.JOURNAL_MODE = 'wal'
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.add_index('i')
+        self.table.insert([{'_id':'a', 'i':0}, {'_id':'x', 'i':[1, 2]}])
+        while self.table._index_some(100)[0]:
+            pass
+        self.assertTrue(self.table.compact())
+        while not self.table._backup.live:
+            self.table._snapshot_some(1)
+        # The index row freed by the first update of x is reused by the update
+        # of a, which is copied over before x's second update.
+        self.table.update({'_id':'x', 'i':[1]})
+        self.table.update({'_id':'a', 'i':5})
+        self.table.update({'_id':'x', 'i':[1, 7]})
+        while self.table._snapshot_some(1):
+            pass
+        self.assertEquals(self.table.search([('i', '>=', 0)]), [{'_id':'x', 'i':[1, 7]}, {'_id':'a', 'i':5}])
+        self.assertEquals(self.table.count([('i', '=', 2)]), 0)
+
+    def test_compression(self):
+        doc = lambda i: {'_id':str(i), 'i':i, 'name':'widget %i'%(i,), 'tags':['blue', 'small'],
+            'when':datetime.date(2010, 1, 1 + i % 28)}
+        self.table.add_index('i')
+        self.table.insert(doc(0))
+        default_config.COMPRESSION = 'zlib'
+        default_config.COMPRESSION_DICTIONARY = 10
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        # not enough documents to train a dictionary on yet
+        self.assertEquals(self.table.info()['compression_dictionary'], None)
+        self.table.insert([doc(i) for i in xrange(1, 20)])
+        size = lambda id: self.table.db.execute('SELECT length(data) FROM _data WHERE _id = ?', (id,)).fetchone()[0]
+        self.assertTrue(size('1') < size('0'))
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        dictionary = self.table.info()['compression_dictionary']
+        self.assertNotEquals(dictionary, None)
+        self.table.insert(doc(20))
+        self.table.update({'_id':'1', 'name':'gadget'})
+        self.assertTrue(size('20') < size('2'))
+        # documents written without compression, without the dictionary and
+        # with it can all be read
+        self.assertEquals(self.table.get(['0', '2', '20']), [doc(0), doc(2), doc(20)])
+        self.assertEquals(self.table.get('1')['name'], 'gadget')
+        self.assertEquals(self.table.search([('i', '<', 3)], limit=3), [doc(0), dict(doc(1), name='gadget'), doc(2)])
+
+        # compression can be turned off again
+        default_config.COMPRESSION = None
+        reader = table.TableAdapter('test_table.sqlite', 'test_table', default_config, True)
+        self.assertEquals(reader.get('20'), doc(20))
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.update(doc(20))
+        self.assertEquals(str(self.table.db.execute("SELECT data FROM _data WHERE _id = '20'").fetchone()[0])[:1], '{')
+        self.assertEquals(self.table.get('20'), doc(20))
+
+    def test_binary_compression(self):
+        doc = lambda i: {'_id':str(i), 'name':u'widget %i'%(i,), 'category':u'hardware',
+            'when':datetime.date(2010, 1, 1 + i % 28), 'tags':[u'blue', u'small']}
+        default_config.DOCUMENT_FORMAT = 'binary'
+        default_config.COMPRESSION = 'zlib'
+        default_config.COMPRESSION_DICTIONARY = 10
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.insert([doc(i) for i in xrange(20)])
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.insert(doc(21))
+        size = lambda id: self.table.db.execute('SELECT length(data) FROM _data WHERE _id = ?', (id,)).fetchone()[0]
+        # the dictionary is of the binary format's strings
+        self.assertTrue(size('21') < size('11') * .65, (size('21'), size('11')))
+        self.assertEquals(self.table.get('21'), doc(21))
+
+    def test_document_format(self):
+        doc = lambda i: {'_id':str(i), 'i':i, 'when':datetime.date(2010, 1, 1 + i % 28),
+            'price':decimal.Decimal('1.25'), 'tags':set(['a', 'b'])}
+        self.table.add_index('i')
+        self.table.insert(doc(0))
+        self.assertEquals(self.table.info()['format'], 'json')
+        default_config.DOCUMENT_FORMAT = 'binary'
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.assertEquals(self.table.info()['format'], 'binary')
+        self.table.insert([doc(1), doc(2)])
+        self.table.update({'_id':'0', 'name':'zero'})
+        formats = dict((_id, str(data)[:1]) for _id, data in
+            self.table.db.execute('SELECT _id, CAST(data AS BLOB) FROM _data'))
+        self.assertEquals(formats, {'0':'\x80', '1':'\x80', '2':'\x80'})
+        self.assertEquals(self.table.search([('i', '<', 2)]), [dict(doc(0), name='zero'), doc(1)])
+
+        # documents in both formats can be read, whichever is written
+        default_config.DOCUMENT_FORMAT = 'json'
+        self.table = table.TableAdapter('test_table.sqlite', 'test_table', default_config)
+        self.table.insert(doc(3))
+        self.assertEquals(self.table.get(['1', '3']), [doc(1), doc(3)])
+        self.assertEquals(self.table.info()['format'], 'json')
+
     def _test_insert_performance(self):
         data = {'col1': 1, 'col2':'hey!', 'col3': datetime.datetime.utcnow()}
         _data = [[dict(data) for i in xrange(5000)] for j in xrange(1)]
@@ -151,3 +649,99 @@ class TableAdapterTest(unittest.TestCase):
             self.table.insert(data)
         print >>sys.stderr, 1000 / (time.time()-t)
         self.assertEquals(list(self.table.db.execute('select count(*) from _data'))[0][0], count + 1000)
+
+
+class MemoryTableAdapterTest(unittest.TestCase):
+    def setUp(self):
+        default_config.BACKEND = 'memory'
+        self.table = backends.open_table(default_config, 'test_memory')
+
+    def tearDown(self):
+        self.table.drop_table(self.table.get_drop_key())
+        del self.table
+        global default_config
+        default_config = reload(default_config)
+
+    def test_basic(self):
+        self.assertEquals(self.table.__class__.__name__, 'MemoryTableAdapter')
+        self.table.add_index('i', '-j')
+        ids = [row[0] for row in self.table.insert([{'i':i % 3, 'j':i} for i in xrange(9)])]
+        self.assertEquals(self.table.get(ids[4]), {'_id':ids[4], 'i':1, 'j':4})
+        out = self.table.search([('i', '=', 1)])
+        self.assertEquals([d['j'] for d in out], [7, 4, 1])
+        out = self.table.search([('i', '>=', 1)], ('-i',), 4)
+        self.assertEquals([d['j'] for d in out], [2, 5, 8, 1])
+        self.assertEquals(self.table.count([('i', '<', 2)]), 6)
+        self.assertEquals(self.table.count([[('i', '=', 0)], [('i', '=', 2)]]), 6)
+        self.assertTrue(self.table.exists([('_id', '=', ids[0])]))
+        self.assertTrue(self.table.exists([['_id', 'IN', ['missing', ids[0]]]]))
+        self.assertFalse(self.table.exists([('i', '>', 2)]))
+        self.table.update({'_id':ids[0], '__ops':'(setv `doc `i (+ (getv `doc `i) 5))'})
+        self.assertEquals(self.table.search([('i', '>', 2)]), [{'_id':ids[0], 'i':5, 'j':0}])
+        self.table.delete(ids[0])
+        self.assertEquals(self.table.get(ids[0]), None)
+        self.assertEquals(self.table.info()['index_rows'], 8)
+
+    def test_rollback(self):
+        self.table.add_index('i')
+        self.table.insert({'_id':'a', 'i':1})
+        self.assertRaises(ValueError, lambda: self.table.insert([{'_id':'b', 'i':2}, {'_id':'a', 'i':3}]))
+        self.assertEquals(self.table.get(['a', 'b']), [{'_id':'a', 'i':1}, None])
+        self.assertEquals(self.table.count([('i', '>', 0)]), 1)
+        done = self.table._group_commit([
+            ('update', ({'_id':'a', 'i':4},), {}),
+            ('insert', ({'_id':'a'},), {}),
+        ])
+        self.assertEquals([e is None for value, e in done], [True, False])
+        self.assertEquals(self.table.search([('i', '=', 4)]), [{'_id':'a', 'i':4}])
+
+    def test_indexes(self):
+        self.table.insert([{'i':i, 's':str(i)} for i in xrange(10)])
+        self.assertRaises(TableIndexError, lambda: self.table.search([('i', '=', 1)]))
+        self.table.add_index('s')
+        self.table.add_index('i')
+        self.assertEquals(self.table.info()['indexes'], ['i,', 's,'])
+        self.assertEquals(self.table.count([('i', '<', 5)]), 5)
+        self.table.drop_index('s')
+        self.assertEquals(self.table.info()['index_rows'], 10)
+        self.assertRaises(TableIndexError, lambda: self.table.search([('s', '=', '1')]))
+        self.assertEquals([d['i'] for d in self.table.search([('i', '>', 7)])], [8, 9])
+
+    def test_snapshot(self):
+        default_config.SNAPSHOT_INTERVAL = 60
+        self.table = backends.open_table(default_config, 'test_memory')
+        self.table.add_index('i')
+        self.table.add_index('name-')
+        self.table.add_index('tags')
+        self.table.insert([{'_id':str(i), 'i':i} for i in xrange(250)])
+        self.table.insert([{'_id':'a', 'i':1000, 'name':'Josiah', 'tags':['x', 'y']}, {'_id':'b', 'i':1001, 'name':'joy', 'tags':['y']}])
+        self.assertTrue(self.table._snapshot_due(True))
+        self.assertFalse(self.table._snapshot_due())
+        self.assertEquals(self.table._snapshot_some(100), 100)
+        # changes after the snapshot started aren't part of it
+        self.table.delete('0')
+        self.assertEquals(self.table.info()['snapshot'], {'documents':252, 'written':100})
+        self.assertEquals(self.table._snapshot_some(200), 152)
+        self.assertEquals(self.table._snapshot_some(200), 0)
+        self.assertEquals(self.table.info()['snapshot'], None)
+
+        restored = backends.open_table(default_config, 'test_memory')
+        self.assertEquals(restored.count([('i', '<', 10)]), 10)
+        self.assertEquals(restored.info()['indexes'], ['i,', 'name-,', 'tags,'])
+        # the snapshot can be used as an ordinary table
+        sqlite_table = table.TableAdapter('test_memory.sqlite', 'test_memory', default_config)
+        self.assertEquals(sqlite_table.indexes_in_progress, ['i,', 'name-,', 'tags,'])
+        while sqlite_table._index_some(100)[0]:
+            pass
+        self.assertEquals(sqlite_table.case_swapped, set())
+        self.assertEquals(sqlite_table.multi_valued, set([sqlite_table.indexes_to_ids['tags,']]))
+        self.assertEquals(sqlite_table.search([('i', '<', 2)]), [{'_id':'0', 'i':0}, {'_id':'1', 'i':1}])
+        for tables in (self.table, restored, sqlite_table):
+            self.assertEquals([d['_id'] for d in tables.search([('name-', '=', 'josiah')])], ['a'])
+            self.assertEquals(tables.count([('tags', '>=', 'x')]), 2)
+        del sqlite_table
+
+        # the delete is written out when the processor is done
+        self.table._flush()
+        restored = backends.open_table(default_config, 'test_memory')
+        self.assertEquals(restored.count([('i', '<', 10)]), 9)